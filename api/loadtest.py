@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# Load generator and benchmark suite for the SQL API. Each scenario sends requests to one endpoint from a number of
+# concurrent clients for a fixed time, and the throughput, latency percentiles and error rate of each scenario are
+# printed as JSON, so that the results of different builds or VM sizes can be compared with a diff.
+# The API is started in a separate process with its production server (with a SQLite database as SQL engine and a
+# local HTTP echo server as target of /api/curl, so that no network is required), or an API running somewhere else
+# can be targeted with --url.
+# Examples:
+#   python3 loadtest.py
+#   python3 loadtest.py --scenario pi --scenario healthcheck --concurrency 16 --duration 30 --output results.json
+#   python3 loadtest.py --url http://myapi:8080 --scenario sql
+import os
+import sys
+import math
+import time
+import json
+import socket
+import operator
+import argparse
+import datetime
+import platform
+import shutil
+import tempfile
+import threading
+import subprocess
+import collections
+import http.server
+import requests
+
+# Scenarios: endpoint, query parameters ({echo_url} and {ioperf_file} are replaced, parameters that end up empty are not
+# sent so that the API uses its default), default number of concurrent clients,
+# and the check of the answer (the API answers errors with status 200 and a JSON string, so the status is not enough)
+scenarios = collections.OrderedDict([
+    ('healthcheck', {
+        'path': '/api/healthcheck',
+        'params': {},
+        'check': lambda answer: answer.get('health') == 'OK'
+    }),
+    ('pi', {
+        'path': '/api/pi',
+        'params': {'digits': '1000'},
+        'check': lambda answer: 'pi' in answer
+    }),
+    ('sql', {
+        'path': '/api/sql',
+        'params': {'QUERY': 'SELECT 1;'},
+        'check': lambda answer: answer.get('sql_output') == '1'
+    }),
+    ('curl', {
+        'path': '/api/curl',
+        'params': {'url': '{echo_url}'},
+        'check': lambda answer: answer.get('status_code') == 200
+    }),
+    ('ioperf', {
+        'path': '/api/ioperf',
+        'params': {'size': '8', 'file': '{ioperf_file}'},
+        'concurrency': 1,       # each request runs a benchmark on the same file
+        'check': lambda answer: 'Written blocks' in answer
+    })
+])
+
+# HTTP server answering any GET request with a short text, the target of the curl scenario
+class EchoHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True     # headers and body are written separately
+
+    def do_GET(self):
+        body = ('echo ' + self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_echo_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{0}/echo'.format(server.server_port)
+
+# Start the API in a new process with the production server (gunicorn, or the Flask server if it is not installed),
+# on a free port and with a SQLite database file in work_dir as SQL engine, and wait until it answers. WEB_WORKERS and
+# the other settings of the server are taken from the environment. The output of the API goes to work_dir/api.log
+def start_api_server(work_dir):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'SERVER_MODE': 'production',
+        'SQL_ENGINE': 'sqlite',
+        'SQL_SQLITE_ENABLED': 'yes',
+        'SQL_SERVER_FQDN': 'localhost',
+        'SQL_SERVER_DB': os.path.join(work_dir, 'loadtest.db'),
+        'SQL_SERVER_USERNAME': 'loadtest',
+        'SQL_SERVER_PASSWORD': 'loadtest',
+        'SECRETS_PATH': os.path.join(work_dir, 'secrets'),
+        'METRICS_DIR': os.path.join(work_dir, 'metrics'),
+        'IOPERF_JOBS_DIR': os.path.join(work_dir, 'ioperf-jobs'),
+        'PUBLIC_IP_URLS': ','       # no public IP lookups, so that the API does not reach out to the Internet
+    })
+    log_path = os.path.join(work_dir, 'api.log')
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql_api.py')],
+                                   env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = 'http://127.0.0.1:{0}'.format(port)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() != None:
+            break
+        try:
+            if requests.get(base_url + '/api/healthcheck', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    stop_api_server(process)
+    with open(log_path, 'r') as log:
+        raise RuntimeError('The API did not start, its output was:\n' + log.read())
+
+def stop_api_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+# Client thread: sends requests in a loop with its own keep-alive session until end, recording the latency of the
+# requests sent after warmup_end (in nanoseconds) and the errors
+def run_client(url, params, check, timeout, warmup_end, end, samples, errors):
+    session = requests.Session()
+    while True:
+        start = time.perf_counter_ns()
+        if start >= end:
+            break
+        error = None
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            if response.status_code >= 400:
+                error = 'HTTP status ' + str(response.status_code)
+            else:
+                answer = response.json()
+                if not isinstance(answer, dict) or not check(answer):
+                    error = 'unexpected answer'
+        except Exception as e:
+            error = type(e).__name__
+        took = time.perf_counter_ns() - start
+        if start >= warmup_end:
+            samples.append(took)
+            if error != None:
+                errors[error] += 1
+    session.close()
+
+# Same latency statistics (in microseconds, out of durations in nanoseconds) as get_latency_stats in sql_api.py, which
+# is not imported so that testing an API running somewhere else does not load the API module here
+def get_latency_stats(samples_ns):
+    n = len(samples_ns)
+    if n == 0:
+        return {}
+    ordered = sorted(samples_ns)
+    total = sum(ordered)
+    sum_squares = sum(map(operator.mul, ordered, ordered))
+    # Integer arithmetic until the last step to avoid losing precision
+    variance = (n * sum_squares - total * total) / (n * n)
+    # Nearest-rank percentiles
+    percentile = lambda p: ordered[min(n - 1, max(0, math.ceil(p / 100 * n) - 1))] / 1000
+    return {
+        'min': round(ordered[0] / 1000, 1),
+        'max': round(ordered[-1] / 1000, 1),
+        'mean': round(total / n / 1000, 1),
+        'stddev': round(math.sqrt(max(variance, 0)) / 1000, 1),
+        'p50': round(percentile(50), 1),
+        'p90': round(percentile(90), 1),
+        'p99': round(percentile(99), 1),
+        'p99.9': round(percentile(99.9), 1)
+    }
+
+def run_scenario(name, base_url, concurrency, duration, warmup, timeout, replacements):
+    scenario = scenarios[name]
+    params = {key: value.format(**replacements) for key, value in scenario['params'].items()}
+    params = {key: value for key, value in params.items() if value != ''}
+    concurrency = concurrency or scenario.get('concurrency', 4)
+    warmup_end = time.perf_counter_ns() + int(warmup * 1e9)
+    end = warmup_end + int(duration * 1e9)
+    samples = [[] for client in range(concurrency)]
+    errors = [collections.Counter() for client in range(concurrency)]
+    threads = [threading.Thread(target=run_client, args=(base_url + scenario['path'], params, scenario['check'], timeout, warmup_end, end, samples[client], errors[client]))
+               for client in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Requests still running at the end are counted, so the time is until the last one finished
+    elapsed = max(duration, (time.perf_counter_ns() - warmup_end) / 1e9)
+    all_samples = [sample for client_samples in samples for sample in client_samples]
+    all_errors = sum(errors, collections.Counter())
+    error_count = sum(all_errors.values())
+    return {
+        'endpoint': scenario['path'],
+        'params': params,
+        'concurrency': concurrency,
+        'duration (sec)': round(elapsed, 3),
+        'requests': len(all_samples),
+        'errors': error_count,
+        'error rate': round(error_count / len(all_samples), 4) if all_samples else None,
+        'error types': dict(all_errors),
+        'throughput (req/s)': round(len(all_samples) / elapsed, 2),
+        'latency (us)': get_latency_stats(all_samples)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the SQL API endpoints')
+    parser.add_argument('--url', help='base URL of the API to test, for example http://localhost:8080 (per default the API is started in a new process)')
+    parser.add_argument('--scenario', action='append', choices=list(scenarios.keys()), help='scenario to run, can be repeated (per default all of them)')
+    parser.add_argument('--concurrency', type=int, help='concurrent clients per scenario (per default 4, 1 for ioperf)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds each scenario runs, after the warm-up (10 per default)')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds each scenario runs before results are recorded (1 per default)')
+    parser.add_argument('--timeout', type=float, default=30, help='timeout of each request in seconds (30 per default)')
+    parser.add_argument('--echo-url', help='URL requested by the API in the curl scenario (per default a local echo server, only reachable by an API in this host)')
+    parser.add_argument('--ioperf-file', help='file written and read by the API in the ioperf scenario (per default a file in a temporary directory for the local API, and the default of the API with --url)')
+    parser.add_argument('--output', help='file where the JSON results are written (per default they are printed)')
+    args = parser.parse_args()
+    selected = args.scenario or list(scenarios.keys())
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    replacements = {'echo_url': args.echo_url, 'ioperf_file': args.ioperf_file or ''}
+    if 'curl' in selected and args.echo_url == None:
+        replacements['echo_url'] = start_echo_server()
+    process = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        process, base_url = start_api_server(work_dir)
+        # The work directory is only visible to an API started by this script
+        if args.ioperf_file == None:
+            replacements['ioperf_file'] = os.path.join(work_dir, 'iotest')
+    results = {
+        'target': args.url or 'local',
+        'started': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scenarios': collections.OrderedDict()
+    }
+    try:
+        for name in selected:
+            print('Running scenario {0} against {1}...'.format(name, base_url), file=sys.stderr)
+            results['scenarios'][name] = run_scenario(name, base_url, args.concurrency, args.duration, args.warmup, args.timeout, replacements)
+    finally:
+        if process != None:
+            stop_api_server(process)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,104 +1,877 @@
+import time
+# Time when the module started loading, to report the startup time in /api/startup
+module_load_start = time.perf_counter()
 import os
 import socket, struct
 import sys
-import time
+import tempfile
+import math
+import mmap
+import random
+import operator
 import warnings
-import requests
-import dns.resolver
-import psycopg2
+import threading
+import atexit
+import signal
+import bisect
+import hashlib
+import zlib
+import ipaddress
+import importlib
+import subprocess
 import datetime
+import decimal
+import uuid
+import json
+import collections
+import queue
+import concurrent.futures
 from random import shuffle
 import urllib.parse
 
 from flask import Flask
 from flask import request
 from flask import jsonify
+from flask import Response
+from flask import g
 
-from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
+# Modules imported on first use instead of when the API starts: the SQL drivers (a container only uses the one of
+# its SQL_ENGINE, and the others do not need to be installed), the Azure SDK, dnspython, requests and gmpy2.
+# The time each import takes is recorded for /api/startup
+lazy_modules = []
 
-# If not using SQL APIs, pyodbc and pymysql are not required and could not be installed
-# If pyodbc is not correclty imported the Azure SQL DB calls will break
-# If pymysql is not correclty imported the Azure SQL DB for MySQL calls will break
-try:
-    import pyodbc
-    import pymysql
-except:
-    pass
+class LazyModule:
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.import_seconds = None
+        self.imported_by = None
+        self.error = None
+        lazy_modules.append(self)
+
+    # There is no lock here: importlib already makes concurrent imports of a module wait for the first one, and a lock
+    # held during the import would stay locked in a process forked by another thread in the meantime
+    def load(self, imported_by='first use'):
+        if self.module == None:
+            if self.error != None:
+                raise self.error
+            start = time.perf_counter()
+            try:
+                module = importlib.import_module(self.name)
+            except ImportError as e:
+                # Not retried, a module that is not installed will not be installed later
+                self.error = e
+                raise
+            if self.module == None:
+                self.import_seconds = time.perf_counter() - start
+                self.imported_by = imported_by
+                self.module = module
+        return self.module
+
+    # Whether the module can be imported (for optional modules)
+    def is_available(self):
+        try:
+            self.load()
+            return True
+        except ImportError:
+            return False
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def get_stats(self):
+        return {
+            'module': self.name,
+            'imported': self.module != None,
+            'imported_by': self.imported_by,
+            'import_ms': round(self.import_seconds * 1000, 3) if self.import_seconds != None else None,
+            'error': str(self.error) if self.error != None else None
+        }
+
+pyodbc = LazyModule('pyodbc')
+pymysql = LazyModule('pymysql')
+psycopg2 = LazyModule('psycopg2')
+psycopg2_extras = LazyModule('psycopg2.extras')
+sqlite3 = LazyModule('sqlite3')
+azure_identity = LazyModule('azure.identity')
+azure_keyvault_secrets = LazyModule('azure.keyvault.secrets')
+dns_resolver = LazyModule('dns.resolver')
+dns_reversename = LazyModule('dns.reversename')
+requests = LazyModule('requests')
+urllib3 = LazyModule('urllib3')
+# gmpy2 is optional, it makes the calculation of the digits of pi much faster
+gmpy2 = LazyModule('gmpy2')
+
+# Modules imported by the warm-up step for each SQL engine
+engine_modules = {
+    'sqlserver': [pyodbc],
+    'mysql': [pymysql],
+    'postgres': [psycopg2, psycopg2_extras],
+    'sqlite': [sqlite3]
+}
 
 # Courtesy of https://github.com/thodnev/MonkeyTest
 class Benchmark:
 
-    def __init__(self, file, write_mb, write_block_kb, read_block_kb):
+    def __init__(self, file, write_mb, write_block_kb, read_block_kb, job=None, iodepth=1, numjobs=1, shared_file=True,
+                 write_pattern='sequential', read_pattern='random', rwmixread=None, direct=False, fsync_every=1, drop_cache=False,
+                 buffer_pool=False, buffer_ring_size=16, buffer_pool_mb=256, mutate_headers=True):
         self.file = file
         self.write_mb = write_mb
         self.write_block_kb = write_block_kb
         self.read_block_kb = read_block_kb
+        self.job = job      # optional IoperfJob to report progress to and check for cancellation
+        self.iodepth = iodepth          # threads issuing I/O operations in parallel in each worker
+        self.numjobs = numjobs          # workers, each one with its own region of the file or its own file
+        self.shared_file = shared_file
+        self.write_pattern = write_pattern      # sequential or random
+        self.read_pattern = read_pattern        # sequential or random
+        self.rwmixread = rwmixread      # percentage of reads in an additional mixed read/write phase (None for no mixed phase)
+        self.direct = direct            # bypass the page cache with O_DIRECT
+        self.fsync_every = fsync_every  # fsync after this number of blocks written by each thread, 0 for only at the end
+        self.drop_cache = drop_cache    # evict the file from the page cache before reading
+        self.buffer_pool = buffer_pool  # write blocks out of a ring of pre-generated random buffers instead of calling urandom for each block
+        self.buffer_ring_size = buffer_ring_size
+        self.buffer_pool_mb = buffer_pool_mb    # memory shared by the rings of all threads
+        self.mutate_headers = mutate_headers    # stamp each 4KB sector of the pre-generated buffers before writing them
+        if direct and (write_block_kb % 4 != 0 or read_block_kb % 4 != 0):
+            raise ValueError('Block sizes need to be multiples of 4KB when using direct I/O')
+        # The written blocks are split between the workers (the first workers get one more block if the division is
+        # not exact), and each worker reads in the region it wrote: (first byte, bytes) in the shared file or its own
         wr_blocks = int(self.write_mb * 1024 / self.write_block_kb)
-        rd_blocks = int(self.write_mb * 1024 / self.read_block_kb)
-        self.write_results = self.write_test (1024 * self.write_block_kb, wr_blocks)
-        self.read_results = self.read_test (1024 * self.read_block_kb, rd_blocks)
+        self.worker_regions = []
+        region_start = 0
+        for worker in range(self.numjobs):
+            region_size = (wr_blocks // self.numjobs + (1 if worker < wr_blocks % self.numjobs else 0)) * 1024 * self.write_block_kb
+            self.worker_regions.append((region_start if self.shared_file else 0, region_size))
+            region_start += region_size
+        self.write_fsync_ns = 0
+        start = time.perf_counter()
+        self.write_workers = self.write_test (1024 * self.write_block_kb)
+        benchmark_phase_duration_seconds.observe(time.perf_counter() - start, 'write')
+        start = time.perf_counter()
+        self.read_workers = self.read_test (1024 * self.read_block_kb)
+        benchmark_phase_duration_seconds.observe(time.perf_counter() - start, 'read')
+        self.write_results = [t for worker in self.write_workers for thread in worker for t in thread]
+        self.read_results = [t for worker in self.read_workers for thread in worker for t in thread]
+        if self.rwmixread != None:
+            start = time.perf_counter()
+            self.mixed_read_workers, self.mixed_write_workers = self.mixed_test (1024 * self.read_block_kb)
+            benchmark_phase_duration_seconds.observe(time.perf_counter() - start, 'mixed')
 
-    def write_test(self, block_size, blocks_count):
+    def write_test(self, block_size):
         '''
-        Tests write speed by writing random blocks, at total quantity
-        of blocks_count, each at size of block_size bytes to disk.
-        Function returns a list of write times in sec of each block.
+        Tests write speed by writing random blocks of block_size bytes
+        to disk, filling the region of each worker.
+        Function returns, for each worker, a list with the write times
+        in nanoseconds of each block written by each of its threads.
         '''
-        f = os.open(self.file, os.O_CREAT | os.O_WRONLY, 0o777)  # low-level I/O
-        took = []
-        for i in range(blocks_count):
-            buff = os.urandom(block_size)
-            start = time.time()
-            os.write(f, buff)
-            os.fsync(f)  # force write to disk
-            t = time.time() - start
-            took.append(t)
-        os.close(f)
+        took, = self.run_workers(['write'], os.O_CREAT | os.O_WRONLY, block_size, self.write_blocks, self.write_pattern == 'random')
         return took
 
-    def read_test(self, block_size, blocks_count):
+    def read_test(self, block_size):
         '''
-        Performs read speed test by reading random offset blocks from
-        file, at maximum of blocks_count, each at size of block_size
-        bytes until the End Of File reached.
-        Returns a list of read times in sec of each block.
+        Performs read speed test by reading blocks of block_size bytes
+        out of the region each worker has written.
+        Returns, for each worker, a list with the read times in
+        nanoseconds of each block read by each of its threads.
         '''
-        f = os.open(self.file, os.O_RDONLY, 0o777)  # low-level I/O
-        # generate random read positions
-        offsets = list(range(0, blocks_count * block_size, block_size))
-        shuffle(offsets)
-        took = []
-        for i, offset in enumerate(offsets, 1):
-            start = time.time()
-            os.lseek(f, offset, os.SEEK_SET)  # set position
-            buff = os.read(f, block_size)  # read from position
-            t = time.time() - start
-            if not buff: break  # if EOF reached
-            took.append(t)
-        os.close(f)
+        if self.drop_cache:
+            self.evict_page_cache()
+        took, = self.run_workers(['read'], os.O_RDONLY, block_size, self.read_blocks, self.read_pattern == 'random')
+        return took
+
+    def mixed_test(self, block_size):
+        '''
+        Reads or writes (rwmixread percent of the operations are reads)
+        blocks of block_size bytes at random offsets of the file.
+        Returns the read and write times in nanoseconds per worker and thread.
+        '''
+        if self.drop_cache:
+            self.evict_page_cache()
+        return self.run_workers(['mixed read', 'mixed write'], os.O_RDWR, block_size, self.mixed_blocks, True)
+
+    def get_worker_file(self, worker):
+        if self.shared_file or self.numjobs == 1:
+            return self.file
+        return '{0}.{1}'.format(self.file, worker)
+
+    # Write dirty pages and ask the kernel to drop the file from the page cache
+    def evict_page_cache(self):
+        for worker in range(self.numjobs if not self.shared_file else 1):
+            f = os.open(self.get_worker_file(worker), os.O_RDONLY)
+            try:
+                os.fsync(f)
+                os.posix_fadvise(f, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(f)
+
+    def run_workers(self, phases, flags, block_size, io_function, random_offsets):
+        '''
+        Runs numjobs workers, each one on the blocks of block_size bytes that fit in
+        its region (worker_regions). With a shared file each worker gets its own
+        region of the file, otherwise each one uses its own file.
+        Each worker runs iodepth threads, that share the file descriptor and send
+        positional I/O operations (pread/pwrite) in parallel. Returns the block times
+        of each worker thread for each of the phases (more than one for mixed I/O).
+        '''
+        if self.direct:
+            flags |= os.O_DIRECT
+        worker_offsets = [list(range(region_start, region_start + region_size - block_size + 1, block_size)) for region_start, region_size in self.worker_regions]
+        took = [[[[] for thread in range(self.iodepth)] for worker in range(self.numjobs)] for phase in phases]
+        if self.job:
+            for i, phase in enumerate(phases):
+                self.job.start_phase(phase, took[i], block_size, sum(map(len, worker_offsets)) if i == 0 else 0)
+        fds = []
+        threads = []
+        errors = []
+        try:
+            for worker in range(self.numjobs):
+                f = os.open(self.get_worker_file(worker), flags, 0o777)  # low-level I/O
+                fds.append(f)
+                offsets = worker_offsets[worker]
+                if random_offsets:
+                    shuffle(offsets)
+                for thread in range(self.iodepth):
+                    thread_took = [took[i][worker][thread] for i in range(len(phases))]
+                    threads.append(threading.Thread(target=self.run_thread, args=(io_function, f, block_size, offsets[thread::self.iodepth], thread_took, errors)))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # With fsync only at the end, the final fsync is timed separately
+            if not errors and self.fsync_every == 0 and flags & (os.O_WRONLY | os.O_RDWR):
+                start = time.perf_counter_ns()
+                for f in fds:
+                    os.fsync(f)
+                if phases == ['write']:
+                    self.write_fsync_ns = time.perf_counter_ns() - start
+        finally:
+            for f in fds:
+                os.close(f)
+        if errors:
+            raise errors[0]
         return took
 
+    def run_thread(self, io_function, f, block_size, offsets, took, errors):
+        try:
+            io_function(f, block_size, offsets, took)
+        except Exception as e:
+            errors.append(e)
+
+    # Buffer aligned to the page size (anonymous mmap), as required by O_DIRECT
+    def get_buffer(self, block_size):
+        return mmap.mmap(-1, block_size)
+
+    # Buffers to write from. Without buffer pool there is a single buffer, refilled with random data
+    # before each write. With buffer pool, a ring of blocks is filled with random data once (up to
+    # 16MB per thread, and up to buffer_pool_mb for all threads together), and the blocks are handed
+    # out as memoryview slices without copying
+    def get_write_buffers(self, block_size):
+        if not self.buffer_pool:
+            return [self.get_buffer(block_size)]
+        ring_bytes = min(16 * 1024 * 1024, self.buffer_pool_mb * 1024 * 1024 // (self.numjobs * self.iodepth))
+        ring_size = max(1, min(self.buffer_ring_size, ring_bytes // block_size))
+        ring = self.get_buffer(block_size * ring_size)
+        chunk_size = 1024 * 1024
+        for start in range(0, len(ring), chunk_size):
+            ring[start:start + chunk_size] = os.urandom(min(chunk_size, len(ring) - start))
+        ring_view = memoryview(ring)
+        return [ring_view[i * block_size:(i + 1) * block_size] for i in range(ring_size)]
+
+    def next_write_buffer(self, buffers, block_size, block_number, token):
+        if not self.buffer_pool:
+            buff = buffers[0]
+            buff[:] = os.urandom(block_size)
+            return buff
+        buff = buffers[block_number % len(buffers)]
+        # A different header in every 4KB sector, so that deduplication cannot skip repeated buffers
+        if self.mutate_headers:
+            for sector in range(0, block_size - BLOCK_HEADER.size + 1, 4096):
+                BLOCK_HEADER.pack_into(buff, sector, token, block_number, sector)
+        return buff
+
+    def write_block(self, f, buff, offset, block_size, blocks_written):
+        start = time.perf_counter_ns()
+        os.pwrite(f, buff, offset)
+        if self.fsync_every > 0 and blocks_written % self.fsync_every == 0:
+            os.fsync(f)  # force write to disk
+        return time.perf_counter_ns() - start
+
+    def read_block(self, f, buff, offset):
+        start = time.perf_counter_ns()
+        read_bytes = os.preadv(f, [buff], offset)  # read from position
+        t = time.perf_counter_ns() - start
+        return t if read_bytes > 0 else None
+
+    def write_blocks(self, f, block_size, offsets, took):
+        buffers = self.get_write_buffers(block_size)
+        token = random.getrandbits(64)
+        for i, offset in enumerate(offsets, 1):
+            buff = self.next_write_buffer(buffers, block_size, i, token)
+            took[0].append(self.write_block(f, buff, offset, block_size, i))
+            if self.job:
+                self.job.check_cancelled()
+
+    def read_blocks(self, f, block_size, offsets, took):
+        buff = self.get_buffer(block_size)
+        for offset in offsets:
+            t = self.read_block(f, buff, offset)
+            if t != None:   # None past the end of the file
+                took[0].append(t)
+            if self.job:
+                self.job.check_cancelled()
+
+    def mixed_blocks(self, f, block_size, offsets, took):
+        buff = self.get_buffer(block_size)
+        write_buffers = self.get_write_buffers(block_size)
+        token = random.getrandbits(64)
+        blocks_written = 0
+        for offset in offsets:
+            if random.random() * 100 < self.rwmixread:
+                t = self.read_block(f, buff, offset)
+                if t != None:
+                    took[0].append(t)
+            else:
+                blocks_written += 1
+                write_buff = self.next_write_buffer(write_buffers, block_size, blocks_written, token)
+                took[1].append(self.write_block(f, write_buff, offset, block_size, blocks_written))
+            if self.job:
+                self.job.check_cancelled()
+
     def get_json_result(self):
         results_json = {}
         results_json["Filepath"] = self.file
+        results_json["Jobs"] = self.numjobs
+        results_json["I/O depth"] = self.iodepth
+        results_json["Direct I/O"] = self.direct
+        results_json["Fsync every N blocks"] = self.fsync_every
+        results_json["Write buffer pool"] = self.buffer_pool
         results_json["Written MB"] = self.write_mb
+        results_json["Write pattern"] = self.write_pattern
         results_json["Write block size (KB)"] = self.write_block_kb
         results_json["Written blocks"] = len(self.write_results)
-        results_json["Write time (sec)"] = round(sum(self.write_results), 2)
-        results_json["Write bandwidth in MiB/s"] = round(self.write_mb / sum(self.write_results), 2)
-        results_json["Write IOPS"] = round(len(self.write_results) / sum(self.write_results), 0)
+        results_json["Written bytes"] = len(self.write_results) * 1024 * self.write_block_kb
+        results_json.update(get_phase_results('Write', self.write_workers, 1024 * self.write_block_kb, self.write_fsync_ns))
+        if self.fsync_every == 0:
+            results_json["Write final fsync time (sec)"] = round(self.write_fsync_ns / 1e9, 3)
+        results_json["Read pattern"] = self.read_pattern
+        results_json["Read cache dropped"] = self.drop_cache
         results_json["Read block size (KB)"] = self.read_block_kb
         results_json["Read blocks"] = len(self.read_results)
-        results_json["Read time (sec)"] = round(sum(self.read_results),2)
-        results_json["Read bandwidth in MiB/s"] = round(self.write_mb / sum(self.read_results),2)
-        results_json["Read IOPS"] = round(len(self.read_results) / sum(self.read_results), 0)
+        results_json["Read bytes"] = len(self.read_results) * 1024 * self.read_block_kb
+        results_json.update(get_phase_results('Read', self.read_workers, 1024 * self.read_block_kb))
+        if self.rwmixread != None:
+            results_json["Mixed read percentage"] = self.rwmixread
+            results_json.update(get_phase_results('Mixed read', self.mixed_read_workers, 1024 * self.read_block_kb))
+            results_json.update(get_phase_results('Mixed write', self.mixed_write_workers, 1024 * self.read_block_kb))
+        if self.numjobs > 1 or self.iodepth > 1:
+            results_json["Workers"] = [{
+                    'Worker': worker,
+                    'File': self.get_worker_file(worker),
+                    'Write': get_worker_results(self.write_workers[worker], 1024 * self.write_block_kb),
+                    'Read': get_worker_results(self.read_workers[worker], 1024 * self.read_block_kb)
+                } for worker in range(self.numjobs)]
         return results_json
 
+# Header stamped in each 4KB sector of pre-generated write buffers: thread token, block number and sector offset
+BLOCK_HEADER = struct.Struct('<QQQ')
+
+# Blocks, time, bandwidth and IOPS of a worker, out of the block times of its threads. Threads run
+# in parallel, so the time of the worker is the busiest thread's time
+def get_worker_results(threads_took, block_size, extra_ns=0):
+    blocks = sum(len(took) for took in threads_took)
+    busy_time = ((max(sum(took) for took in threads_took) if threads_took else 0) + extra_ns) / 1e9
+    return {
+        'blocks': blocks,
+        'bytes': blocks * block_size,
+        'time (sec)': round(busy_time, 2),
+        'bandwidth in MiB/s': round(blocks * block_size / 1024 / 1024 / busy_time, 2) if busy_time > 0 else None,
+        'IOPS': round(blocks / busy_time, 0) if busy_time > 0 else None
+    }
+
+# Combined results of all workers for one phase of the benchmark (Write or Read)
+def get_phase_results(phase, workers_took, block_size, extra_ns=0):
+    threads_took = [took for worker in workers_took for took in worker]
+    samples = [t for took in threads_took for t in took]
+    combined = get_worker_results(threads_took, block_size, extra_ns)
+    return {
+        phase + " time (sec)": combined['time (sec)'],
+        phase + " bandwidth in MiB/s": combined['bandwidth in MiB/s'],
+        phase + " IOPS": combined['IOPS'],
+        phase + " latency (us)": get_latency_stats(samples),
+        phase + " latency histogram (us)": get_latency_histogram(samples)
+    }
+
+# Latency statistics in microseconds out of a list of durations in nanoseconds. Apart from one sort,
+# everything runs inside C loops (sum, map) so that it stays cheap for millions of samples
+# (loadtest.py has a copy of this function, keep both identical)
+def get_latency_stats(samples_ns):
+    n = len(samples_ns)
+    if n == 0:
+        return {}
+    ordered = sorted(samples_ns)
+    total = sum(ordered)
+    sum_squares = sum(map(operator.mul, ordered, ordered))
+    # Integer arithmetic until the last step to avoid losing precision
+    variance = (n * sum_squares - total * total) / (n * n)
+    # Nearest-rank percentiles
+    percentile = lambda p: ordered[min(n - 1, max(0, math.ceil(p / 100 * n) - 1))] / 1000
+    return {
+        'min': round(ordered[0] / 1000, 1),
+        'max': round(ordered[-1] / 1000, 1),
+        'mean': round(total / n / 1000, 1),
+        'stddev': round(math.sqrt(max(variance, 0)) / 1000, 1),
+        'p50': round(percentile(50), 1),
+        'p90': round(percentile(90), 1),
+        'p99': round(percentile(99), 1),
+        'p99.9': round(percentile(99.9), 1)
+    }
+
+# Histogram with logarithmic (power of two) buckets out of a list of durations in nanoseconds.
+# The bucket of a sample is its bit length, so samples in bucket b are below 2^b nanoseconds
+def get_latency_histogram(samples_ns):
+    buckets = collections.Counter(map(int.bit_length, samples_ns))
+    return [{'le': (2 ** b) / 1000, 'count': buckets[b]} for b in sorted(buckets)]
+
+# Raised inside a benchmark when its job has been cancelled
+class BenchmarkCancelled(Exception):
+    pass
+
+# I/O benchmark running in the background, keeping track of its progress and results. Its status is saved to the
+# job store when its state changes and every IOPERF_JOB_SAVE_INTERVAL seconds while it runs, so that the other
+# worker processes of the production server can report it
+class IoperfJob:
+
+    def __init__(self, params):
+        self.id = str(uuid.uuid4())
+        self.params = params
+        self.state = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.future = None
+        self.phases = collections.OrderedDict()   # phase name -> (block times of each worker thread, block size, total blocks)
+        self.cancel_event = threading.Event()
+        self.save_interval = float(get_variable_value('IOPERF_JOB_SAVE_INTERVAL', 1))
+        self.saved = 0
+        self.save_lock = threading.Lock()
+
+    # Called by the benchmark when a new phase starts. The lists of block times are filled by the benchmark
+    def start_phase(self, phase, workers_took, block_size, blocks_count):
+        self.phases[phase] = (workers_took, block_size, blocks_count)
+
+    # Called by the benchmark threads after each block. From time to time, one of them saves the progress and
+    # looks for a cancellation requested by another process
+    def check_cancelled(self):
+        if time.monotonic() - self.saved > self.save_interval and self.save_lock.acquire(blocking=False):
+            try:
+                if is_ioperf_job_cancel_requested(self.id):
+                    self.cancel_event.set()
+                self.save()
+            finally:
+                self.save_lock.release()
+        if self.cancel_event.is_set():
+            raise BenchmarkCancelled('Job ' + self.id + ' cancelled')
+
+    def save(self):
+        self.saved = time.monotonic()
+        save_ioperf_job_status(self.get_status())
+
+    def run(self):
+        if self.cancel_event.is_set() or is_ioperf_job_cancel_requested(self.id):
+            self.state = 'cancelled'
+            self.finished = time.time()
+            ioperf_job_finished(self)
+            return
+        self.state = 'running'
+        self.started = time.time()
+        self.save()
+        try:
+            benchmark = create_benchmark(self.params, job=self)
+            self.result = benchmark.get_json_result()
+            self.state = 'completed'
+        except BenchmarkCancelled:
+            self.state = 'cancelled'
+        except Exception as e:
+            self.error = str(e)
+            self.state = 'failed'
+        finally:
+            self.finished = time.time()
+            ioperf_job_finished(self)
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.future != None and self.future.cancel():
+            self.state = 'cancelled'
+            self.finished = time.time()
+            ioperf_job_finished(self)
+
+    def get_progress(self):
+        blocks_total = 0
+        blocks_done = 0
+        partial_results = {}
+        for phase, (workers_took, block_size, blocks_count) in list(self.phases.items()):
+            partial_results[phase] = get_worker_results([took for worker in workers_took for took in worker], block_size)
+            partial_results[phase]['blocks_total'] = blocks_count
+            blocks_total += blocks_count
+            blocks_done += partial_results[phase]['blocks']
+        # The read phase has not started yet while writing, so estimate its blocks from the parameters
+        if 'read' not in self.phases:
+            blocks_total += int(self.params['size'] * 1024 / self.params['readblocksize'])
+        if 'write' not in self.phases:
+            blocks_total += int(self.params['size'] * 1024 / self.params['writeblocksize'])
+        return {
+            'phase': next(reversed(self.phases), None),
+            'percent': round(100 * blocks_done / blocks_total, 1) if blocks_total > 0 else 0,
+            'partial_results': partial_results
+        }
+
+    def get_status(self):
+        status = {
+            'job_id': self.id,
+            'state': self.state,
+            'pid': os.getpid(),
+            'params': self.params,
+            'submitted': str(datetime.datetime.utcfromtimestamp(self.submitted)),
+            'started': str(datetime.datetime.utcfromtimestamp(self.started)) if self.started else None,
+            'finished': str(datetime.datetime.utcfromtimestamp(self.finished)) if self.finished else None,
+            'error': self.error,
+            'result': self.result
+        }
+        if self.state != 'completed':
+            status['progress'] = self.get_progress()
+        return status
+
+# Run a benchmark with the parameters supplied to /api/ioperf
+def create_benchmark(params, job=None):
+    return Benchmark(params['file'], params['size'], params['writeblocksize'], params['readblocksize'], job=job,
+                     iodepth=params['iodepth'], numjobs=params['numjobs'], shared_file=params['sharedfile'],
+                     write_pattern=params['writepattern'], read_pattern=params['readpattern'], rwmixread=params['rwmixread'],
+                     direct=params['direct'], fsync_every=params['fsync'], drop_cache=params['dropcache'],
+                     buffer_pool=params['bufferpool'], buffer_pool_mb=int(get_variable_value('IOPERF_BUFFER_POOL_MB', 256)),
+                     mutate_headers=params['mutateheaders'])
+
+# Background I/O benchmark jobs queued or running in this process. Every job has also a JSON file with its status
+# in the job store (IOPERF_JOBS_DIR), shared by all the worker processes, where the last IOPERF_JOB_HISTORY finished
+# jobs are kept. Another process cancels a job by creating the file <job id>.cancel next to it
+ioperf_jobs = collections.OrderedDict()
+ioperf_jobs_lock = threading.Lock()
+ioperf_executor = None
+
+def get_ioperf_executor():
+    global ioperf_executor
+    with ioperf_jobs_lock:
+        if ioperf_executor == None:
+            ioperf_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(get_variable_value('IOPERF_MAX_JOBS', 2)), thread_name_prefix='ioperf')
+        return ioperf_executor
+
+def get_ioperf_jobs_dir():
+    jobs_dir = get_variable_value('IOPERF_JOBS_DIR') or os.path.join(tempfile.gettempdir(), 'sqlapi-ioperf-jobs')
+    os.makedirs(jobs_dir, exist_ok=True)
+    return jobs_dir
+
+# Job IDs are UUIDs, anything else raises ValueError instead of becoming a path outside of the job store
+def get_ioperf_job_path(job_id, extension='.json'):
+    return os.path.join(get_ioperf_jobs_dir(), str(uuid.UUID(job_id)) + extension)
+
+# Write the status file of a job, through a temporary file (one per thread) so that readers never see it half-written
+def save_ioperf_job_status(status):
+    path = get_ioperf_job_path(status['job_id'])
+    temp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'w') as file:
+        json.dump(status, file)
+    os.replace(temp_path, path)
+
+# Status of a job out of the job store, None if there is no such job. A job left queued or running by a worker
+# process that does not exist anymore (for example restarted by gunicorn after a timeout) is reported as failed
+def load_ioperf_job_status(job_id):
+    try:
+        with open(get_ioperf_job_path(job_id), 'r') as file:
+            status = json.load(file)
+    except (ValueError, OSError):
+        return None
+    if status['state'] in ('queued', 'running'):
+        try:
+            os.kill(status['pid'], 0)
+        except ProcessLookupError:
+            status['error'] = 'Worker process {0} exited while the job was {1}'.format(status['pid'], status['state'])
+            status['state'] = 'failed'
+        except OSError:
+            pass
+    return status
+
+def is_ioperf_job_cancel_requested(job_id):
+    return os.path.exists(get_ioperf_job_path(job_id, '.cancel'))
+
+def submit_ioperf_job(params):
+    job = IoperfJob(params)
+    executor = get_ioperf_executor()
+    job.save()
+    with ioperf_jobs_lock:
+        ioperf_jobs[job.id] = job
+    job.future = executor.submit(job.run)
+    return job
+
+# Status of a job, from memory if it runs in this process (with up-to-date progress) or from the job store
+def get_ioperf_job_status(job_id):
+    with ioperf_jobs_lock:
+        job = ioperf_jobs.get(job_id)
+    if job != None:
+        return job.get_status()
+    return load_ioperf_job_status(job_id)
+
+# Statuses of all the jobs in the job store, oldest first
+def get_ioperf_job_statuses():
+    statuses = []
+    for file_name in os.listdir(get_ioperf_jobs_dir()):
+        if file_name.endswith('.json'):
+            status = get_ioperf_job_status(file_name[:-len('.json')])
+            if status != None:
+                statuses.append(status)
+    return sorted(statuses, key=lambda status: status['submitted'])
+
+# Cancel a job running in this process, or ask the process where it runs to cancel it. Returns the status of the
+# job (that can still be running until its process notices), or None if there is no such job
+def cancel_ioperf_job(job_id):
+    with ioperf_jobs_lock:
+        job = ioperf_jobs.get(job_id)
+    if job != None:
+        job.cancel()
+        return job.get_status()
+    status = load_ioperf_job_status(job_id)
+    if status != None and status['state'] in ('queued', 'running'):
+        open(get_ioperf_job_path(job_id, '.cancel'), 'w').close()
+    return status
+
+# Save the final status of a job and forget it in this process. The oldest finished jobs beyond
+# IOPERF_JOB_HISTORY are removed from the job store
+def ioperf_job_finished(job):
+    max_history = int(get_variable_value('IOPERF_JOB_HISTORY', 50))
+    job.save()
+    with ioperf_jobs_lock:
+        ioperf_jobs.pop(job.id, None)
+    finished = [status for status in get_ioperf_job_statuses() if status['finished'] != None]
+    for status in finished[:max(0, len(finished) - max_history)]:
+        for extension in ('.json', '.cancel'):
+            try:
+                os.remove(get_ioperf_job_path(status['job_id'], extension))
+            except OSError:
+                pass
+
 def init_odbc(cx_string):
     cnxn = pyodbc.connect(cx_string)
     return cnxn
 
+# Open an ODBC connection with the output converters used by the API
+def connect_odbc(cx_string):
+    cx = init_odbc(cx_string)
+    cx.add_output_converter(-150, handle_sql_variant_as_string)
+    return cx
+
+# Pool of database connections sharing the same engine, server, database, user and SSL setting
+class SqlConnectionPool:
+
+    def __init__(self, key, max_size, idle_timeout, wait_timeout, validate_after):
+        self.key = key
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.validate_after = validate_after
+        self.idle = []      # list of (connection, time it was returned to the pool)
+        self.in_use = 0
+        self.condition = threading.Condition()
+        self.metrics = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'evicted_idle': 0,
+            'failed_health_checks': 0,
+            'connect_errors': 0,
+            'waits': 0,
+            'wait_timeouts': 0
+        }
+
+    def acquire(self, connect):
+        '''
+        Returns a connection out of the pool. Idle connections are health-checked
+        before being handed out only if they have been idle for longer than
+        validate_after seconds, and a new one is opened in autocommit mode with the
+        connect function if there is no idle connection and the pool is not full yet.
+        If the pool is full, waits up to wait_timeout seconds for a connection to be
+        released.
+        '''
+        while True:
+            cx = None
+            last_used = None
+            with self.condition:
+                deadline = time.time() + self.wait_timeout
+                while not self.idle and self.in_use >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.metrics['wait_timeouts'] += 1
+                        raise Exception('Timed out waiting for a free connection in pool ' + self.name())
+                    self.metrics['waits'] += 1
+                    self.condition.wait(remaining)
+                expired = self.pop_expired()
+                if self.idle:
+                    cx, last_used = self.idle.pop()
+                self.in_use += 1
+            close_connections(expired)
+            if cx == None:
+                break
+            # Recently used connections are handed out without a round trip to the server
+            if time.time() - last_used <= self.validate_after or is_connection_healthy(cx):
+                with self.condition:
+                    self.metrics['reused'] += 1
+                return cx
+            # Broken connection, drop it and try with the next one
+            close_connections([cx])
+            with self.condition:
+                self.metrics['failed_health_checks'] += 1
+                self.in_use -= 1
+                self.condition.notify()
+        try:
+            cx = connect()
+            set_autocommit(cx, self.key[0], True)
+        except Exception:
+            with self.condition:
+                self.metrics['connect_errors'] += 1
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.metrics['created'] += 1
+        return cx
+
+    def release(self, cx, discard=False, transaction=False):
+        '''
+        Returns a connection to the pool. If the borrower opened a transaction with
+        set_autocommit(cx, engine, False), it is committed and the connection goes
+        back to autocommit mode. Connections that failed or cannot be committed are
+        closed instead.
+        '''
+        if transaction and not discard:
+            try:
+                cx.commit()
+                set_autocommit(cx, self.key[0], True)
+            except Exception:
+                discard = True
+        with self.condition:
+            self.in_use -= 1
+            if discard:
+                self.metrics['discarded'] += 1
+            else:
+                self.idle.append((cx, time.time()))
+            self.condition.notify()
+        if discard:
+            close_connections([cx])
+
+    # Remove idle connections not used for longer than idle_timeout (to be called with the lock held)
+    def pop_expired(self):
+        now = time.time()
+        expired = [cx for (cx, last_used) in self.idle if now - last_used > self.idle_timeout]
+        if expired:
+            self.idle = [(cx, last_used) for (cx, last_used) in self.idle if now - last_used <= self.idle_timeout]
+            self.metrics['evicted_idle'] += len(expired)
+        return expired
+
+    def evict_idle(self):
+        with self.condition:
+            expired = self.pop_expired()
+        close_connections(expired)
+
+    def name(self):
+        return '{0}://{3}@{1}/{2} (ssl={4})'.format(*self.key[:5])
+
+    def get_stats(self):
+        self.evict_idle()
+        with self.condition:
+            return {
+                'pool': self.name(),
+                'engine': self.key[0],
+                'max_size': self.max_size,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'metrics': dict(self.metrics)
+            }
+
+# Close a list of connections ignoring errors
+def close_connections(connections):
+    for cx in connections:
+        try:
+            cx.close()
+        except Exception:
+            pass
+
+# Switch a connection in or out of autocommit mode. Pooled connections are in autocommit mode, so that reads need
+# no commit when the connection is returned, and writers open a transaction by switching it off
+def set_autocommit(cx, sql_engine, autocommit):
+    if sql_engine == 'mysql':
+        cx.autocommit(autocommit)
+    elif sql_engine == 'sqlite':
+        cx.isolation_level = None if autocommit else 'DEFERRED'
+    else:
+        cx.autocommit = autocommit
+
+# Send a trivial query to verify that a pooled connection is still alive
+def is_connection_healthy(cx):
+    try:
+        cursor = cx.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+# Connection pools, indexed by engine, server, database, user and SSL setting
+sql_pools = {}
+sql_pools_lock = threading.Lock()
+
+# Return the connection pool for a given combination of connection parameters, creating it if required
+def get_sql_pool(sql_engine, sql_server_fqdn, sql_server_db, sql_server_username, use_ssl, sql_server_password, pooled=True):
+    if not pooled:
+        return UnpooledConnections()
+    # The password is not part of the pool name, but it is part of the key: otherwise a request
+    # supplying the wrong password could get a connection authenticated by somebody else
+    password_hash = hashlib.sha256(str(sql_server_password).encode('utf-8')).hexdigest()
+    key = (sql_engine, sql_server_fqdn, sql_server_db, sql_server_username, use_ssl, password_hash)
+    with sql_pools_lock:
+        pool = sql_pools.get(key)
+        if pool == None:
+            pool = SqlConnectionPool(key,
+                max_size=int(get_variable_value('SQL_POOL_SIZE') or 10),
+                idle_timeout=int(get_variable_value('SQL_POOL_IDLE_TIMEOUT') or 300),
+                wait_timeout=int(get_variable_value('SQL_POOL_WAIT_TIMEOUT') or 30),
+                validate_after=int(get_variable_value('SQL_POOL_VALIDATE_AFTER') or 30))
+            sql_pools[key] = pool
+        return pool
+
+# Time the driver took to open the last connection of UnpooledConnections in this thread
+sql_connect_timing = threading.local()
+
+# Same interface as SqlConnectionPool, but each connection is new and it is closed when released. Used for
+# measurements that need to include the connection setup (/api/sqlping)
+class UnpooledConnections:
+
+    def acquire(self, connect):
+        start = time.perf_counter()
+        cx = connect()
+        sql_connect_timing.seconds = time.perf_counter() - start
+        return cx
+
+    def release(self, cx, discard=False, transaction=False):
+        if transaction and not discard:
+            try:
+                cx.commit()
+            except Exception:
+                pass
+        close_connections([cx])
+
 def get_sqlversion(cx):
     cursor = cx.cursor()
     cursor.execute('SELECT @@VERSION')
@@ -111,9 +884,13 @@ def get_sqlsrcip(cx):
 
 def get_sqlquery(cx, query):
     cursor = cx.cursor()
+    start = time.perf_counter()
     cursor.execute(query)
+    sql_phase_duration_seconds.observe(time.perf_counter() - start, 'sqlserver', 'execute')
     try:
+        start = time.perf_counter()
         rows = cursor.fetchall()
+        sql_phase_duration_seconds.observe(time.perf_counter() - start, 'sqlserver', 'fetch')
         app.logger.info('Query "' + query + '" has returned ' + str(len(rows)) + ' rows')
         app.logger.info('Variable type for first row: ' + str(type(rows[0])))
         if len(rows) > 0:
@@ -128,14 +905,204 @@ def get_sqlquery(cx, query):
         app.logger.info('Query "' + query + '" has returned no rows')
         return None
 
-def get_variable_value(variable_name):
-    variable_value = os.environ.get(variable_name)
-    basis_path='/secrets'
-    variable_path = os.path.join(basis_path, variable_name)
-    if variable_value == None and os.path.isfile(variable_path):
-        with open(variable_path, 'r') as file:
-            variable_value = file.read().replace('\n', '')
-    return variable_value
+# Configuration values coming from environment variables or from files in the secrets directory (where
+# Kubernetes mounts secrets). The files are read once at startup, and a background thread re-reads them
+# when the modification time of the directory or of any file changes, so that rotated secrets are picked
+# up without doing any file I/O when serving requests
+# The same class is in dash/sql_dash.py: each app is deployed as a single file, keep both copies identical
+class ConfigResolver:
+
+    def __init__(self, secrets_path='/secrets', poll_interval=10):
+        self.secrets_path = secrets_path
+        self.poll_interval = poll_interval
+        self.secrets = {}
+        self.signature = None
+        self.watcher_pid = None
+        self.lock = threading.Lock()
+        self.reload()
+
+    # Modification times and sizes of the secrets directory and its files (following symlinks)
+    def get_signature(self):
+        try:
+            entries = [(self.secrets_path, os.stat(self.secrets_path).st_mtime_ns)]
+            for entry in os.scandir(self.secrets_path):
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            return tuple(sorted(entries))
+        except Exception:
+            return None
+
+    def reload(self):
+        signature = self.get_signature()
+        secrets = {}
+        if signature != None:
+            for entry in os.scandir(self.secrets_path):
+                try:
+                    if entry.is_file():
+                        with open(entry.path, 'r') as file:
+                            secrets[entry.name] = file.read().replace('\n', '')
+                except Exception:
+                    pass
+        with self.lock:
+            self.secrets = secrets
+            self.signature = signature
+
+    def watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                if self.get_signature() != self.signature:
+                    print('Change detected in ' + self.secrets_path + ', reloading secrets...')
+                    self.reload()
+            except Exception as e:
+                print('Error reloading secrets from ' + self.secrets_path + ': ' + str(e))
+
+    # Start the watcher thread (again if the process has been forked, with a new lock in case
+    # the watcher of the parent process was holding it when forking)
+    def start_watcher(self):
+        if self.watcher_pid != os.getpid():
+            if self.watcher_pid != None:
+                self.lock = threading.Lock()
+            self.watcher_pid = os.getpid()
+            threading.Thread(target=self.watch, daemon=True).start()
+
+    def get(self, variable_name, default_value=None):
+        variable_value = os.environ.get(variable_name)
+        if variable_value == None:
+            with self.lock:
+                variable_value = self.secrets.get(variable_name)
+        if variable_value == None:
+            variable_value = default_value
+        return variable_value
+
+config = ConfigResolver(secrets_path=os.environ.get('SECRETS_PATH', '/secrets'),
+                        poll_interval=int(os.environ.get('SECRETS_POLL_INTERVAL', '10')))
+# The watcher thread is started by start_background_tasks, in the process that serves the requests
+
+def get_variable_value(variable_name, default_value=None):
+    return config.get(variable_name, default_value)
+
+# Process-wide cache of Azure Key Vault secrets. Values are served from memory while they are
+# younger than ttl seconds, and stale values are still served (up to max_stale seconds) while a
+# background thread fetches the new one. The Azure credential and the Key Vault clients are
+# created once and reused, a stub credential or client factory can be supplied for testing
+class AkvSecretCache:
+
+    def __init__(self, ttl=300, max_stale=3600, credential=None, client_factory=None):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.credential = credential
+        if client_factory == None:
+            client_factory = lambda vault_url, credential: azure_keyvault_secrets.SecretClient(vault_url=vault_url, credential=credential)
+        self.client_factory = client_factory
+        self.clients = {}
+        self.secrets = {}       # (akv_name, secret_name) -> (value, time when it was retrieved)
+        self.fetch_locks = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.metrics = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'errors': 0
+        }
+
+    def get_client(self, akv_name):
+        akv_uri = f"https://{akv_name}.vault.azure.net"
+        with self.lock:
+            if self.credential == None:
+                app.logger.info('Authenticating to Azure...')
+                self.credential = azure_identity.DefaultAzureCredential()
+            client = self.clients.get(akv_uri)
+            if client == None:
+                app.logger.info('Creating AKV client for {0}...'.format(akv_uri))
+                client = self.client_factory(akv_uri, self.credential)
+                self.clients[akv_uri] = client
+            return client
+
+    def fetch(self, akv_name, secret_name):
+        '''
+        Retrieves the secret from Azure Key Vault, bypassing the cache,
+        and stores the new value in the cache.
+        '''
+        key = (akv_name, secret_name)
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(key, threading.RLock())
+        with fetch_lock:
+            app.logger.info('Getting secret {0} from AKV {1}...'.format(secret_name, akv_name))
+            start = time.perf_counter()
+            try:
+                value = self.get_client(akv_name).get_secret(secret_name).value
+            except Exception:
+                akv_fetch_duration_seconds.observe(time.perf_counter() - start, 'error')
+                with self.lock:
+                    self.metrics['errors'] += 1
+                raise
+            akv_fetch_duration_seconds.observe(time.perf_counter() - start, 'ok')
+            with self.lock:
+                self.secrets[key] = (value, time.time())
+            return value
+
+    # A cache entry that is missing or older than ttl + max_stale cannot be returned
+    def is_expired(self, entry):
+        return entry == None or time.time() - entry[1] > self.ttl + self.max_stale
+
+    def get_secret(self, akv_name, secret_name):
+        key = (akv_name, secret_name)
+        with self.lock:
+            entry = self.secrets.get(key)
+        if self.is_expired(entry):
+            with self.lock:
+                fetch_lock = self.fetch_locks.setdefault(key, threading.RLock())
+            # Only one thread fetches a missing secret (or one too old to be served stale), the rest wait for its value
+            with fetch_lock:
+                with self.lock:
+                    entry = self.secrets.get(key)
+                    expired = self.is_expired(entry)
+                    if expired:
+                        self.metrics['misses'] += 1
+                if expired:
+                    return self.fetch(akv_name, secret_name)
+        value, retrieved = entry
+        age = time.time() - retrieved
+        if age <= self.ttl:
+            with self.lock:
+                self.metrics['hits'] += 1
+            return value
+        with self.lock:
+            self.metrics['stale_hits'] += 1
+            start_refresh = key not in self.refreshing
+            if start_refresh:
+                self.refreshing.add(key)
+        if start_refresh:
+            threading.Thread(target=self.refresh, args=(akv_name, secret_name), daemon=True).start()
+        return value
+
+    def refresh(self, akv_name, secret_name):
+        try:
+            self.fetch(akv_name, secret_name)
+            with self.lock:
+                self.metrics['refreshes'] += 1
+        except Exception as e:
+            app.logger.error('Error refreshing secret {0} from AKV {1}: {2}'.format(secret_name, akv_name, str(e)))
+        finally:
+            with self.lock:
+                self.refreshing.discard((akv_name, secret_name))
+
+    def get_stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                'ttl': self.ttl,
+                'max_stale': self.max_stale,
+                'secrets': [{'akv_name': key[0], 'secret_name': key[1], 'age': round(now - retrieved, 1)} for key, (value, retrieved) in self.secrets.items()],
+                'metrics': dict(self.metrics)
+            }
+
+akv_secret_cache = AkvSecretCache(ttl=int(get_variable_value('AKV_SECRET_TTL') or 300),
+                                  max_stale=int(get_variable_value('AKV_SECRET_MAX_STALE') or 3600))
 
 # Return True if IP address is valid
 def is_valid_ipv4_address(address):
@@ -156,7 +1123,7 @@ def handle_sql_variant_as_string(value):
     # return value.decode('utf-16le')
     return value.decode('utf-8')
 
-# Calculates x digits of number pi
+# Calculates x digits of number pi (spigot algorithm, kept to reproduce old load profiles)
 def pi_digits(x):
     """Generate x digits of Pi."""
     k,a,b,a1,b1 = 2,4,1,12,4
@@ -170,7 +1137,68 @@ def pi_digits(x):
             a,a1 = 10*(a % b), 10*(a1 % b1)
             d,d1 = a/b, a1/b1
 
-def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_username = None, sql_server_password = None, sql_query = None, sql_engine=None, use_ssl=None):
+# Calculates x digits of number pi with the Chudnovsky series and binary splitting, using only
+# integer arithmetic (gmpy2 integers if available). Returns a string like "3.14159" for x=6
+def pi_chudnovsky(x):
+    mpz = gmpy2.mpz if gmpy2.is_available() else int
+    isqrt = gmpy2.isqrt if gmpy2.is_available() else math.isqrt
+    C3_OVER_24 = mpz(640320 ** 3 // 24)
+    # P, Q and T of the terms a to b-1 of the series
+    def bs(a, b):
+        if b - a == 1:
+            if a == 0:
+                Pab = Qab = mpz(1)
+            else:
+                Pab = mpz((6 * a - 5) * (2 * a - 1) * (6 * a - 1))
+                Qab = mpz(a) * a * a * C3_OVER_24
+            Tab = Pab * (13591409 + 545140134 * a)
+            if a & 1:
+                Tab = -Tab
+        else:
+            m = (a + b) // 2
+            Pam, Qam, Tam = bs(a, m)
+            Pmb, Qmb, Tmb = bs(m, b)
+            Pab = Pam * Pmb
+            Qab = Qam * Qmb
+            Tab = Qmb * Tam + Pam * Tmb
+        return Pab, Qab, Tab
+    # Some guard digits, each term of the series adds about 14.18 digits
+    digits = x + 10
+    terms = int(digits / 14.181647462725477) + 1
+    P, Q, T = bs(0, terms)
+    one = mpz(10) ** digits
+    sqrt_10005 = isqrt(10005 * one * one)
+    pi = (Q * 426880 * sqrt_10005) // T
+    pi_str = big_int_to_str(pi)
+    return pi_str[0] + '.' + pi_str[1:x]
+
+# Decimal representation of a big integer. Since Python 3.11 str() refuses plain integers with more
+# than 4300 digits, so those are converted via the decimal module
+def big_int_to_str(n):
+    if not isinstance(n, int):
+        return str(n)
+    context = decimal.Context(prec=int(n.bit_length() * 0.30103) + 2, Emax=decimal.MAX_EMAX)
+    return str(context.create_decimal(n))
+
+# Send a parameterized statement for a batch of rows, returns the number of rows sent. Postgres statements use a single
+# %s placeholder for all the values, so that psycopg2 sends multi-row inserts (executemany sends one statement per row)
+def execute_sql_batch(cx, sql_engine, sql_query, sql_params):
+    cursor = cx.cursor()
+    if sql_engine == 'sqlserver':
+        cursor.fast_executemany = True
+    if sql_engine == 'postgres':
+        psycopg2_extras.execute_values(cursor, sql_query, sql_params, page_size=len(sql_params))
+    else:
+        cursor.executemany(sql_query, sql_params)
+    cursor.close()
+    return len(sql_params)
+
+# If sql_function is supplied, it is called with a pooled connection and the engine instead of sending sql_query,
+# and its result is returned. Errors raised by sql_function are raised again after discarding the connection.
+# Connections are in autocommit mode, unless transaction is set: then sql_function runs in a transaction that is
+# committed if it returns, and rolled back (by closing the connection) if it raises
+def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_username = None, sql_server_password = None, sql_query = None, sql_engine=None, use_ssl=None, sql_function=None, pooled=True, transaction=False):
+    start = time.perf_counter()
     # Only set the sql_server_fqdn and db variable if not supplied as argument
     if sql_server_fqdn == None:
         sql_server_fqdn = get_variable_value('SQL_SERVER_FQDN')
@@ -185,15 +1213,8 @@ def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_user
             akv_name = get_variable_value('AKV_NAME')
             akv_secret_name = get_variable_value('AKV_SECRET_NAME')
             if akv_name and akv_secret_name:
-                akv_uri = f"https://{akv_name}.vault.azure.net"
                 try:
-                    app.logger.info('Authenticating to Azure...')
-                    azure_credential = DefaultAzureCredential()
-                    app.logger.info('Creating AKV client...')
-                    akv_client = SecretClient(vault_url=akv_uri, credential=azure_credential)
-                    app.logger.info('Getting secret value from AKV...')
-                    akv_secret = akv_client.get_secret(akv_secret_name)
-                    sql_server_password = akv_secret.value
+                    sql_server_password = akv_secret_cache.get_secret(akv_name, akv_secret_name)
                     sql_server_password_length = len(sql_server_password)
                     app.logger.info('Database password {1} successfully retrieved from Azure Key Vault {0}...'.format(akv_name, '*' * sql_server_password_length))
                 except Exception as e:
@@ -217,6 +1238,8 @@ def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_user
     if sql_server_username == None or sql_server_password == None or sql_server_fqdn == None:
         print('DEBUG - Required environment variables not present')
         return 'Required environment variables not present: ' + str(sql_server_fqdn) + ' :' + str(sql_server_username) + '/' + str(sql_server_password)    # Build connection string
+    # Resolving the connection parameters includes getting the password from Azure Key Vault
+    sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine if sql_engine in ('sqlserver', 'mysql', 'postgres', 'sqlite') else 'unsupported', 'resolve')
     if sql_engine == "sqlserver":
         if sql_query == None:
             sql_query = 'SELECT @@VERSION'
@@ -237,10 +1260,12 @@ def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_user
                 cx_string = "Driver={{{0}}};Server=tcp:{1},1433;Database={2};Uid={3};Pwd={4};Encrypt=yes;TrustServerCertificate=yes;Connection Timeut=30;".format(driver, sql_server_fqdn, sql_server_db, sql_server_username, sql_server_password)
             app.logger.info('connection string: ' + cx_string)
         # Connect to DB
-        app.logger.info('Connecting to database server ' + sql_server_fqdn + ' - ' + get_ip(sql_server_fqdn) + '...')
+        app.logger.info('Connecting to database server ' + sql_server_fqdn + ' - ' + str(get_ip(sql_server_fqdn)) + '...')
+        pool = get_sql_pool(sql_engine, sql_server_fqdn, sql_server_db, sql_server_username, use_ssl, sql_server_password, pooled)
         try:
-            cx = init_odbc(cx_string)
-            cx.add_output_converter(-150, handle_sql_variant_as_string)
+            start = time.perf_counter()
+            cx = pool.acquire(lambda: connect_odbc(cx_string))
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'connect')
         except Exception as e:
             if is_valid_ipv4_address(sql_server_fqdn):
                 error_msg = 'SQL Server FQDN should not be an IP address when targeting Azure SQL Databse, maybe this is a problem?'
@@ -252,15 +1277,26 @@ def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_user
         # Send SQL query
         app.logger.info('Sending SQL query ' + sql_query + '...')
         try:
+            if sql_function != None:
+                if transaction:
+                    set_autocommit(cx, sql_engine, False)
+                start = time.perf_counter()
+                sql_output = sql_function(cx, sql_engine)
+                sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'execute')
+                pool.release(cx, transaction=transaction)
+                return sql_output
             # sql_output = get_sqlversion(cx)
             # sql_output = get_sqlsrcip(cx)
             sql_output = get_sqlquery(cx, sql_query)
-            app.logger.info('Closing SQL connection...')
-            cx.close()
+            app.logger.info('Returning SQL connection to the pool...')
+            pool.release(cx)
             return str(sql_output)
         except Exception as e:
             # app.logger.error('Error sending query to the database')
             app.logger.error(e)
+            pool.release(cx, discard=True)
+            if sql_function != None:
+                raise
             return None
     elif sql_engine == 'mysql':
         if sql_query == None:
@@ -278,41 +1314,63 @@ def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_user
             if use_ssl == 'yes':
                 if sql_server_db == None:
                     app.logger.info('Connecting with SSL to mysql server ' + str(sql_server_fqdn) + ', username ' + str(sql_server_username) + ', password ' + str(sql_server_password))
-                    db = pymysql.connect(host=sql_server_fqdn, user=sql_server_username, passwd=sql_server_password, ssl={'ssl':{'ca': 'BaltimoreCyberTrustRoot.crt.pem'}})
+                    connect = lambda: pymysql.connect(host=sql_server_fqdn, user=sql_server_username, passwd=sql_server_password, ssl={'ssl':{'ca': 'BaltimoreCyberTrustRoot.crt.pem'}})
                 else:
                     app.logger.info('Connecting with SSL to mysql server ' + str(sql_server_fqdn) + ', database ' + str(sql_server_db) + ', username ' + str(sql_server_username) + ', password ' + str(sql_server_password))
-                    db = pymysql.connect(host=sql_server_fqdn, user=sql_server_username, paswd=sql_server_password, database=sql_server_db, ssl={'ssl':{'ca': 'BaltimoreCyberTrustRoot.crt.pem'}})
+                    connect = lambda: pymysql.connect(host=sql_server_fqdn, user=sql_server_username, passwd=sql_server_password, database=sql_server_db, ssl={'ssl':{'ca': 'BaltimoreCyberTrustRoot.crt.pem'}})
             else:
                 if sql_server_db == None:
                     app.logger.info('Connecting without SSL to mysql server ' + str(sql_server_fqdn) + ', username ' + str(sql_server_username) + ', password ' + str(sql_server_password))
-                    db = pymysql.connect(host=sql_server_fqdn, user=sql_server_username, passwd=sql_server_password)
+                    connect = lambda: pymysql.connect(host=sql_server_fqdn, user=sql_server_username, passwd=sql_server_password)
                 else:
                     app.logger.info('Connecting without SSL to mysql server ' + str(sql_server_fqdn) + ', database ' + str(sql_server_db) + ', username ' + str(sql_server_username) + ', password ' + str(sql_server_password))
-                    db = pymysql.connect(host=sql_server_fqdn, user=sql_server_username, passwd=sql_server_password, database=sql_server_db)
+                    connect = lambda: pymysql.connect(host=sql_server_fqdn, user=sql_server_username, passwd=sql_server_password, database=sql_server_db)
+            pool = get_sql_pool(sql_engine, sql_server_fqdn, sql_server_db, sql_server_username, use_ssl, sql_server_password, pooled)
+            start = time.perf_counter()
+            db = pool.acquire(connect)
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'connect')
+        except Exception as e:
+            error_msg = "Error, something happened when connecting to a MySQL server"
+            app.logger.info(error_msg)
+            app.logger.error(e)
+            return str(e)
+        try:
+            if sql_function != None:
+                if transaction:
+                    set_autocommit(db, sql_engine, False)
+                start = time.perf_counter()
+                sql_output = sql_function(db, sql_engine)
+                sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'execute')
+                pool.release(db, transaction=transaction)
+                return sql_output
             # Send query and extract data
             cursor = db.cursor()
+            start = time.perf_counter()
             cursor.execute(sql_query)
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'execute')
             # Option 1: first row only
             # data = cursor.fetchone()
             # Option 2: all rows
+            start = time.perf_counter()
             rows = cursor.fetchall()
-            data = ''
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'fetch')
             app.logger.info('Query "' + sql_query + '" has returned ' + str(len(rows)) + ' rows')
-            app.logger.info('Variable type for first row: ' + str(type(rows[0])))
             if len(rows) > 0:
-                for row in rows:
-                    if len(data) > 0:
-                        data += ', '
-                    data += str(''.join(row))
+                app.logger.info('Variable type for first row: ' + str(type(rows[0])))
+                data = ', '.join(''.join(str(value) for value in row) for row in rows)
             else:
+                pool.release(db)
                 return None
             # Return value
-            db.close()
-            return str(data)
+            pool.release(db)
+            return data
         except Exception as e:
             error_msg = "Error, something happened when sending a query to a MySQL server"
             app.logger.info(error_msg)
             app.logger.error(e)
+            pool.release(db, discard=True)
+            if sql_function != None:
+                raise
             return str(e)
     elif sql_engine == "postgres":
         if sql_query == None:
@@ -334,42 +1392,900 @@ def send_sql_query(sql_server_fqdn = None, sql_server_db = None, sql_server_user
             else:
                 conn_string = "host='" + str(sql_server_fqdn) + "' user='" + str(sql_server_username) + "' password='" + str(sql_server_password)+ "' dbname='" + str(sql_server_db) + "'"
                 app.logger.info('Connecting to Postgres with connection string: ' + conn_string)
+            pool = get_sql_pool(sql_engine, sql_server_fqdn, sql_server_db, sql_server_username, use_ssl, sql_server_password, pooled)
+            start = time.perf_counter()
+            conn = pool.acquire(lambda: psycopg2.connect(conn_string))
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'connect')
+        except Exception as e:
+            error_msg = "Error, something happened when connecting to a Postgres server"
+            app.logger.info(error_msg)
+            app.logger.error(e)
+            return str(e)
+        try:
+            if sql_function != None:
+                if transaction:
+                    set_autocommit(conn, sql_engine, False)
+                start = time.perf_counter()
+                sql_output = sql_function(conn, sql_engine)
+                sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'execute')
+                pool.release(conn, transaction=transaction)
+                return sql_output
             # Send query and extract data
-            conn = psycopg2.connect(conn_string)
-
             cursor = conn.cursor()
+            start = time.perf_counter()
             cursor.execute(sql_query)
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'execute')
+            start = time.perf_counter()
             data = cursor.fetchone()
-            conn.close()
-            return str(''.join(data))
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'fetch')
+            pool.release(conn)
+            if data == None:
+                return None
+            return ''.join(str(value) for value in data)
         except Exception as e:
             error_msg = "Error, something happened when sending a query to a MySQL server"
             app.logger.info(error_msg)
             app.logger.error(e)
+            pool.release(conn, discard=True)
+            if sql_function != None:
+                raise
+            return str(e)
+    elif sql_engine == "sqlite":
+        # Local SQLite database in the file SQL_SERVER_DB, a stand-in for benchmarks and tests without a database server
+        # (the server, username and password are not used). The engine and the database can be supplied in requests, so
+        # it needs SQL_SQLITE_ENABLED=yes (set by loadtest.py), and the database is in memory or in the temporary directory
+        if get_variable_value('SQL_SQLITE_ENABLED', 'no') != 'yes':
+            error_msg = 'DB engine sqlite not enabled'
+            app.logger.error(error_msg)
+            return error_msg
+        sqlite_db = sql_server_db or ':memory:'
+        temp_dir = os.path.realpath(tempfile.gettempdir())
+        if sqlite_db != ':memory:' and os.path.commonpath([os.path.realpath(sqlite_db), temp_dir]) != temp_dir:
+            error_msg = 'SQLite databases can only be in memory or in the directory ' + temp_dir
+            app.logger.error(error_msg)
+            return error_msg
+        if sql_query == None:
+            sql_query = "SELECT sqlite_version();"
+        try:
+            pool = get_sql_pool(sql_engine, sql_server_fqdn, sql_server_db, sql_server_username, use_ssl, sql_server_password, pooled)
+            start = time.perf_counter()
+            conn = pool.acquire(lambda: sqlite3.connect(sqlite_db, check_same_thread=False))
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'connect')
+        except Exception as e:
+            error_msg = "Error, something happened when opening a SQLite database"
+            app.logger.info(error_msg)
+            app.logger.error(e)
+            return str(e)
+        try:
+            if sql_function != None:
+                if transaction:
+                    set_autocommit(conn, sql_engine, False)
+                start = time.perf_counter()
+                sql_output = sql_function(conn, sql_engine)
+                sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'execute')
+                pool.release(conn, transaction=transaction)
+                return sql_output
+            cursor = conn.cursor()
+            start = time.perf_counter()
+            cursor.execute(sql_query)
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'execute')
+            start = time.perf_counter()
+            data = cursor.fetchone()
+            sql_phase_duration_seconds.observe(time.perf_counter() - start, sql_engine, 'fetch')
+            cursor.close()
+            pool.release(conn)
+            return str(data[0]) if data != None else None
+        except Exception as e:
+            error_msg = "Error, something happened when sending a query to a SQLite database"
+            app.logger.info(error_msg)
+            app.logger.error(e)
+            pool.release(conn, discard=True)
+            if sql_function != None:
+                raise
             return str(e)
     else:
         error_msg = 'DB engine ' + sql_engine + ' not supported'
         app.logger.error(error_msg)
         return error_msg
 
+# Statements for the srciplog table (one row per logged connection) and the srciplog_rollup table (hits per IP and
+# minute, maintained when buffered rows are written), with the placeholders and the time index of each engine:
+# clustered index on timestamp for SQL Server, primary key on the auto-increment id for MySQL (InnoDB tables are
+# clustered on it, so in insertion order) with a secondary index on timestamp, and a BRIN index for Postgres
+srciplog_queries = {
+    'sqlserver': {
+        'columns': "SELECT column_name FROM information_schema.columns WHERE table_schema = SCHEMA_NAME() AND table_name = 'srciplog';",
+        'rename_legacy': "EXEC sp_rename 'srciplog', 'srciplog_legacy';",
+        'create': [
+            "IF OBJECT_ID('srciplog', 'U') IS NULL CREATE TABLE srciplog (id bigint IDENTITY(1,1) NOT NULL CONSTRAINT pk_srciplog PRIMARY KEY NONCLUSTERED, ip varchar(45) NOT NULL, timestamp datetime2(3) NOT NULL, INDEX ix_srciplog_timestamp CLUSTERED (timestamp));",
+            "IF OBJECT_ID('srciplog_rollup', 'U') IS NULL CREATE TABLE srciplog_rollup (minute datetime2(0) NOT NULL, ip varchar(45) NOT NULL, hits bigint NOT NULL, CONSTRAINT pk_srciplog_rollup PRIMARY KEY CLUSTERED (minute, ip));"
+        ],
+        'migrate': [
+            "INSERT INTO srciplog (ip, timestamp) SELECT ip, ts FROM (SELECT LEFT(ip, 45) AS ip, TRY_CONVERT(datetime2(3), timestamp) AS ts FROM srciplog_legacy) AS legacy WHERE ip IS NOT NULL AND ts IS NOT NULL;",
+            "INSERT INTO srciplog_rollup (minute, ip, hits) SELECT DATEADD(minute, DATEDIFF(minute, 0, ts), 0), ip, COUNT(*) FROM (SELECT LEFT(ip, 45) AS ip, TRY_CONVERT(datetime2(3), timestamp) AS ts FROM srciplog_legacy) AS legacy WHERE ip IS NOT NULL AND ts IS NOT NULL GROUP BY DATEADD(minute, DATEDIFF(minute, 0, ts), 0), ip;",
+            "DROP TABLE srciplog_legacy;"
+        ],
+        'insert': "INSERT INTO srciplog (ip, timestamp) VALUES (?, ?);",
+        'rollup': "MERGE srciplog_rollup WITH (HOLDLOCK) AS t USING (VALUES (?, ?, ?)) AS s (minute, ip, hits) ON t.minute = s.minute AND t.ip = s.ip WHEN MATCHED THEN UPDATE SET hits = t.hits + s.hits WHEN NOT MATCHED THEN INSERT (minute, ip, hits) VALUES (s.minute, s.ip, s.hits);",
+        'purge': ["DELETE FROM srciplog WHERE timestamp < ?;", "DELETE FROM srciplog_rollup WHERE minute < ?;"],
+        'stats': "SELECT ip, SUM(hits) FROM srciplog_rollup WHERE minute >= ? GROUP BY ip ORDER BY SUM(hits) DESC;"
+    },
+    'mysql': {
+        'columns': "SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = 'srciplog';",
+        'rename_legacy': "RENAME TABLE srciplog TO srciplog_legacy;",
+        'create': [
+            "CREATE TABLE IF NOT EXISTS srciplog (id bigint NOT NULL AUTO_INCREMENT, ip varchar(45) NOT NULL, timestamp datetime(3) NOT NULL, PRIMARY KEY (id), INDEX ix_srciplog_timestamp (timestamp));",
+            "CREATE TABLE IF NOT EXISTS srciplog_rollup (minute datetime NOT NULL, ip varchar(45) NOT NULL, hits bigint NOT NULL, PRIMARY KEY (minute, ip));"
+        ],
+        'migrate': [
+            "INSERT INTO srciplog (ip, timestamp) SELECT LEFT(ip, 45), CAST(timestamp AS DATETIME(3)) FROM srciplog_legacy WHERE ip IS NOT NULL AND CAST(timestamp AS DATETIME(3)) IS NOT NULL;",
+            "INSERT INTO srciplog_rollup (minute, ip, hits) SELECT DATE_FORMAT(CAST(timestamp AS DATETIME), '%Y-%m-%d %H:%i:00'), LEFT(ip, 45), COUNT(*) FROM srciplog_legacy WHERE ip IS NOT NULL AND CAST(timestamp AS DATETIME) IS NOT NULL GROUP BY 1, 2;",
+            "DROP TABLE srciplog_legacy;"
+        ],
+        'insert': "INSERT INTO srciplog (ip, timestamp) VALUES (%s, %s);",
+        'rollup': "INSERT INTO srciplog_rollup (minute, ip, hits) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE hits = hits + VALUES(hits);",
+        'purge': ["DELETE FROM srciplog WHERE timestamp < %s;", "DELETE FROM srciplog_rollup WHERE minute < %s;"],
+        'stats': "SELECT ip, SUM(hits) FROM srciplog_rollup WHERE minute >= %s GROUP BY ip ORDER BY SUM(hits) DESC;"
+    },
+    'postgres': {
+        'columns': "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'srciplog';",
+        'rename_legacy': "ALTER TABLE srciplog RENAME TO srciplog_legacy;",
+        'create': [
+            "CREATE TABLE IF NOT EXISTS srciplog (id bigserial PRIMARY KEY, ip varchar(45) NOT NULL, timestamp timestamp(3) NOT NULL);",
+            "CREATE INDEX IF NOT EXISTS ix_srciplog_timestamp ON srciplog USING brin (timestamp);",
+            "CREATE TABLE IF NOT EXISTS srciplog_rollup (minute timestamp(0) NOT NULL, ip varchar(45) NOT NULL, hits bigint NOT NULL, PRIMARY KEY (minute, ip));"
+        ],
+        'migrate': [
+            "INSERT INTO srciplog (ip, timestamp) SELECT left(ip, 45), timestamp::timestamp(3) FROM srciplog_legacy WHERE ip IS NOT NULL AND timestamp ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}';",
+            "INSERT INTO srciplog_rollup (minute, ip, hits) SELECT date_trunc('minute', timestamp::timestamp), left(ip, 45), COUNT(*) FROM srciplog_legacy WHERE ip IS NOT NULL AND timestamp ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}' GROUP BY 1, 2;",
+            "DROP TABLE srciplog_legacy;"
+        ],
+        'insert': "INSERT INTO srciplog (ip, timestamp) VALUES %s;",
+        'rollup': "INSERT INTO srciplog_rollup (minute, ip, hits) VALUES %s ON CONFLICT (minute, ip) DO UPDATE SET hits = srciplog_rollup.hits + EXCLUDED.hits;",
+        'purge': ["DELETE FROM srciplog WHERE timestamp < %s;", "DELETE FROM srciplog_rollup WHERE minute < %s;"],
+        'stats': "SELECT ip, SUM(hits) FROM srciplog_rollup WHERE minute >= %s GROUP BY ip ORDER BY SUM(hits) DESC;"
+    }
+}
+
+def execute_sql_statements(cx, statements, params=None):
+    cursor = cx.cursor()
+    for statement in statements:
+        if params == None:
+            cursor.execute(statement)
+        else:
+            cursor.execute(statement, params)
+    cursor.close()
+
+# Create the srciplog and srciplog_rollup tables if they do not exist. A srciplog table with the old schema (IP and
+# timestamp as strings, no id) is renamed, and its rows are copied into the new tables. Returns what has been done
+def init_srciplog(cx, sql_engine):
+    queries = srciplog_queries[sql_engine]
+    cursor = cx.cursor()
+    cursor.execute(queries['columns'])
+    columns = [row[0].lower() for row in cursor.fetchall()]
+    cursor.close()
+    legacy = len(columns) > 0 and 'id' not in columns
+    if legacy:
+        execute_sql_statements(cx, [queries['rename_legacy']])
+    execute_sql_statements(cx, queries['create'])
+    migrated_rows = 0
+    if legacy:
+        cursor = cx.cursor()
+        cursor.execute(queries['migrate'][0])
+        migrated_rows = cursor.rowcount
+        cursor.close()
+        execute_sql_statements(cx, queries['migrate'][1:])
+    return {
+        'table_created': 'srciplog',
+        'rollup_table_created': 'srciplog_rollup',
+        'legacy_table_migrated': legacy,
+        'migrated_rows': migrated_rows
+    }
+
+# Time of the last retention purge for each target database
+srciplog_purged = {}
+
+# Write a batch of (ip, timestamp) rows to srciplog, add them to the per-minute counters of srciplog_rollup and,
+# if SRCIPLOG_RETENTION_DAYS is set, delete the old rows (once per hour). Everything is committed together
+def write_srciplog_rows(cx, sql_engine, rows, target):
+    queries = srciplog_queries[sql_engine]
+    execute_sql_batch(cx, sql_engine, queries['insert'], rows)
+    hits = collections.Counter((timestamp.replace(second=0, microsecond=0), ip) for ip, timestamp in rows)
+    execute_sql_batch(cx, sql_engine, queries['rollup'], [(minute, ip, count) for (minute, ip), count in hits.items()])
+    retention_days = float(get_variable_value('SRCIPLOG_RETENTION_DAYS') or 0)
+    if retention_days > 0 and time.time() - srciplog_purged.get(target, 0) > 3600:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+        execute_sql_statements(cx, queries['purge'], (cutoff,))
+        srciplog_purged[target] = time.time()
+    return len(rows)
+
+# Hits per IP since a given time, out of the rollup table
+def get_srciplog_stats(cx, sql_engine, since):
+    cursor = cx.cursor()
+    cursor.execute(srciplog_queries[sql_engine]['stats'], (since,))
+    rows = cursor.fetchall()
+    cursor.close()
+    return [{'ip': row[0], 'hits': int(row[1])} for row in rows]
+
+# Write-behind buffer for the rows logged by /api/sqlsrciplog. Rows are kept in memory, grouped by target database,
+# and written in batches by a background thread when a target has batch_size rows or every flush_interval seconds,
+# with write_function(connection, engine, rows, target). If a batch cannot be written its rows are kept for the
+# next flush, up to max_rows (the oldest rows are dropped)
+class SqlWriteBuffer:
+
+    def __init__(self, write_function, batch_size=100, flush_interval=5, max_rows=10000):
+        self.write_function = write_function
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.rows = collections.OrderedDict()       # target (connection parameters) -> list of rows
+        self.depth = 0
+        self.flusher_pid = None
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.metrics = {
+            'added': 0,
+            'flushed': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'dropped': 0,
+            'last_flush_ms': None,
+            'last_error': None
+        }
+
+    def add(self, target, row):
+        self.start_flusher()
+        with self.condition:
+            self.rows.setdefault(target, []).append(row)
+            self.depth += 1
+            self.metrics['added'] += 1
+            self.drop_oldest()
+            if len(self.rows[target]) >= self.batch_size:
+                self.condition.notify()
+
+    # Drop the oldest rows if the buffer is over max_rows (to be called with the lock held)
+    def drop_oldest(self):
+        while self.depth > self.max_rows:
+            target, rows = next(iter(self.rows.items()))
+            dropped = min(len(rows), self.depth - self.max_rows)
+            del rows[:dropped]
+            if not rows:
+                del self.rows[target]
+            self.depth -= dropped
+            self.metrics['dropped'] += dropped
+
+    def flush(self):
+        '''
+        Writes all the buffered rows, returns the number of rows written
+        '''
+        # Only one flush at a time, so that rows of a failed batch are not reordered by a concurrent flush
+        with self.flush_lock:
+            with self.condition:
+                batches = list(self.rows.items())
+                self.rows = collections.OrderedDict()
+                self.depth = 0
+            written = 0
+            for target, rows in batches:
+                sql_server_fqdn, sql_server_db, sql_server_username, sql_server_password, sql_engine, use_ssl = target
+                start = time.perf_counter()
+                try:
+                    result = send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username,
+                                            sql_server_password=sql_server_password, sql_engine=sql_engine, use_ssl=use_ssl,
+                                            sql_function=lambda cx, sql_engine: self.write_function(cx, sql_engine, rows, target), transaction=True)
+                except Exception as e:
+                    result = str(e)
+                with self.condition:
+                    self.metrics['flushes'] += 1
+                    self.metrics['last_flush_ms'] = round((time.perf_counter() - start) * 1000, 3)
+                    # The write function returns the number of rows, send_sql_query returns an error message if it cannot connect
+                    if isinstance(result, int):
+                        self.metrics['flushed'] += result
+                        written += result
+                    else:
+                        app.logger.error('Error writing {0} buffered rows: {1}'.format(len(rows), str(result)))
+                        self.metrics['flush_errors'] += 1
+                        self.metrics['last_error'] = str(result)
+                        self.rows[target] = rows + self.rows.get(target, [])
+                        self.rows.move_to_end(target, last=False)
+                        self.depth += len(rows)
+                        self.drop_oldest()
+            return written
+
+    def flush_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: any(len(rows) >= self.batch_size for rows in self.rows.values()), timeout=self.flush_interval)
+                flush_errors = self.metrics['flush_errors']
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error('Error flushing the write buffer: ' + str(e))
+            # Do not retry failed batches straight away, even if they are over batch_size
+            with self.condition:
+                failed = self.metrics['flush_errors'] > flush_errors
+            if failed:
+                time.sleep(self.flush_interval)
+
+    # Start the flusher thread (again if the process has been forked: the rows buffered by the parent process
+    # are left to the parent, and the locks are new in case they were held when forking)
+    def start_flusher(self):
+        if self.flusher_pid != os.getpid():
+            with self.start_lock:
+                if self.flusher_pid != os.getpid():
+                    if self.flusher_pid != None:
+                        self.condition = threading.Condition()
+                        self.flush_lock = threading.Lock()
+                        self.rows = collections.OrderedDict()
+                        self.depth = 0
+                    self.flusher_pid = os.getpid()
+                    threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'depth': self.depth,
+                'targets': len(self.rows),
+                'batch_size': self.batch_size,
+                'flush_interval': self.flush_interval,
+                'max_rows': self.max_rows,
+                'metrics': dict(self.metrics)
+            }
+
+srciplog_buffer = SqlWriteBuffer(write_srciplog_rows,
+                                 batch_size=int(get_variable_value('SRCIPLOG_BATCH_SIZE') or 100),
+                                 flush_interval=float(get_variable_value('SRCIPLOG_FLUSH_INTERVAL') or 5),
+                                 max_rows=int(get_variable_value('SRCIPLOG_MAX_ROWS') or 10000))
+
+# Process-wide cache of DNS answers, so that names resolved on every request (like the SQL server FQDN)
+# only generate DNS traffic when their TTL expires. Answers come from dnspython (which tells which
+# nameserver answered), names that DNS does not know (like the ones in /etc/hosts) are resolved by
+# the system resolver. Negative answers are cached too, for negative_ttl seconds
+class DnsCache:
+
+    def __init__(self, max_entries=1024, negative_ttl=30, fallback_ttl=60, timeout=5):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.fallback_ttl = fallback_ttl
+        self.timeout = timeout
+        self.resolver = None
+        self.entries = collections.OrderedDict()     # (name, type) -> (answer, time when it expires)
+        self.lock = threading.Lock()
+        self.metrics = {
+            'hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'fallbacks': 0,
+            'errors': 0
+        }
+
+    def get_resolver(self):
+        with self.lock:
+            if self.resolver == None:
+                self.resolver = dns_resolver.Resolver()
+                self.resolver.lifetime = self.timeout
+            return self.resolver
+
+    def lookup(self, name, rdtype):
+        '''
+        Sends the query to the DNS servers, falling back to the system resolver if DNS has no answer.
+        Returns the answer and how long it can be cached
+        '''
+        answer = {'name': name, 'type': rdtype, 'addresses': [], 'nameserver': None, 'source': 'dns'}
+        try:
+            if rdtype == 'PTR':
+                dns_answer = self.get_resolver().resolve(dns_reversename.from_address(name), 'PTR')
+                answer['addresses'] = [rdata.to_text().rstrip('.') for rdata in dns_answer]
+            else:
+                dns_answer = self.get_resolver().resolve(name, rdtype, search=True)
+                answer['addresses'] = [rdata.to_text() for rdata in dns_answer]
+            answer['nameserver'] = dns_answer.nameserver
+            return answer, dns_answer.rrset.ttl
+        except Exception as e:
+            dns_error = e
+        # Names in /etc/hosts (like our own hostname) or in other NSS sources are not in DNS
+        with self.lock:
+            self.metrics['fallbacks'] += 1
+        answer['source'] = 'system'
+        try:
+            if rdtype == 'PTR':
+                fqdn, aliases, ips = socket.gethostbyaddr(name)
+                answer['addresses'] = [fqdn] + aliases
+            else:
+                family = socket.AF_INET6 if rdtype == 'AAAA' else socket.AF_INET
+                addresses = [address[4][0] for address in socket.getaddrinfo(name, None, family, socket.SOCK_STREAM)]
+                answer['addresses'] = list(dict.fromkeys(addresses))
+            return answer, self.fallback_ttl
+        except Exception:
+            pass
+        with self.lock:
+            self.metrics['errors'] += 1
+        answer['source'] = 'dns'
+        answer['error'] = str(dns_error)
+        # Timeouts and unreachable servers are not cached, only answers saying that the name does not exist
+        if isinstance(dns_error, (dns_resolver.NXDOMAIN, dns_resolver.NoAnswer)):
+            return answer, self.negative_ttl
+        return answer, 0
+
+    def resolve(self, name, rdtype='A', nocache=False):
+        '''
+        Returns the addresses for name (or the names for an IP address if rdtype is PTR), together with
+        the nameserver that answered, the remaining TTL and how long the lookup took
+        '''
+        start = time.perf_counter()
+        rdtype = rdtype.upper()
+        if rdtype not in ('A', 'AAAA', 'PTR'):
+            raise ValueError('DNS record type ' + rdtype + ' not supported, use A, AAAA or PTR')
+        # IP literals do not need any lookup
+        if rdtype != 'PTR':
+            try:
+                ip_address = ipaddress.ip_address(name)
+                return {'name': name, 'type': rdtype, 'addresses': [str(ip_address)], 'nameserver': None, 'source': 'literal',
+                        'ttl': None, 'cached': False, 'lookup_ms': round((time.perf_counter() - start) * 1000, 3)}
+            except ValueError:
+                pass
+        key = (name.lower(), rdtype)
+        now = time.monotonic()
+        if not nocache:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry != None and entry[1] > now:
+                    self.entries.move_to_end(key)
+                    answer, expires = entry
+                    if 'error' in answer:
+                        self.metrics['negative_hits'] += 1
+                    else:
+                        self.metrics['hits'] += 1
+                    answer = dict(answer, ttl=int(expires - now), cached=True)
+                    answer['lookup_ms'] = round((time.perf_counter() - start) * 1000, 3)
+                    return answer
+        answer, ttl = self.lookup(name, rdtype)
+        with self.lock:
+            self.metrics['misses'] += 1
+            if ttl > 0:
+                self.entries[key] = (answer, time.monotonic() + ttl)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.metrics['evictions'] += 1
+        answer = dict(answer, ttl=ttl, cached=False)
+        answer['lookup_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        return answer
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'max_entries': self.max_entries,
+                'negative_ttl': self.negative_ttl,
+                'entries': [{'name': key[0], 'type': key[1], 'addresses': answer['addresses'], 'negative': 'error' in answer, 'ttl': int(expires - now)}
+                            for key, (answer, expires) in self.entries.items() if expires > now],
+                'metrics': dict(self.metrics)
+            }
+
+dns_cache = DnsCache(max_entries=int(get_variable_value('DNS_CACHE_SIZE') or 1024),
+                     negative_ttl=int(get_variable_value('DNS_NEGATIVE_TTL') or 30),
+                     fallback_ttl=int(get_variable_value('DNS_FALLBACK_TTL') or 60),
+                     timeout=float(get_variable_value('DNS_TIMEOUT') or 5))
+
 # Get IP for a DNS name
-def get_ip(d):
+def get_ip(d, nocache=False):
     try:
-        return socket.gethostbyname(d)
+        answer = dns_cache.resolve(d, 'A', nocache=nocache)
+        if answer['addresses']:
+            return answer['addresses'][0]
+        return False
     except Exception:
         return False
 
-# Get IP for a DNS name
-def reverse_dns(ip):
+# Get the DNS name for an IP, in the same format as socket.gethostbyaddr: (name, aliases, IP addresses)
+def reverse_dns(ip, nocache=False):
     try:
-        return socket.gethostbyaddr(ip)
+        answer = dns_cache.resolve(ip, 'PTR', nocache=nocache)
+        if answer['addresses']:
+            return (answer['addresses'][0], answer['addresses'][1:], [ip])
+        return False
     except Exception:
         return False
+# Timing breakdown of the HTTP requests sent by this thread (DNS, TCP connect, TLS handshake and
+# time to first byte), recorded by the connection classes below while http_get is running, and the
+# deadline after which the request is not retried any more
+http_timing = threading.local()
+
+def record_http_timing(phase, seconds):
+    timings = getattr(http_timing, 'timings', None)
+    if timings != None:
+        timings[phase] = timings.get(phase, 0) + seconds
+
+# Connection classes that record the timing breakdown, the requests adapter that uses them and the retry policy. They are
+# subclasses of urllib3 and requests classes, so they are created the first time they are needed (these modules are
+# imported lazily)
+http_adapter_class = None
+http_retry_class = None
+
+def get_http_adapter_class():
+    global http_adapter_class, http_retry_class
+    if http_adapter_class != None:
+        return http_adapter_class
+
+    class DeadlineRetry(urllib3.util.Retry):
+
+        def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+            # No retry (or backoff) would finish before the deadline of the request
+            new_retry = super().increment(method, url, response, error, _pool, _stacktrace)
+            deadline = getattr(http_timing, 'deadline', None)
+            if deadline != None and time.perf_counter() + new_retry.get_backoff_time() >= deadline:
+                raise urllib3.exceptions.MaxRetryError(_pool, url, error or urllib3.exceptions.ResponseError('deadline reached'))
+            return new_retry
+
+    class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+
+        def _new_conn(self):
+            # Resolve the name separately from the TCP connection, so that both can be timed
+            start = time.perf_counter()
+            try:
+                addresses = socket.getaddrinfo(self._dns_host, self.port, 0, socket.SOCK_STREAM)
+            except socket.gaierror as e:
+                raise urllib3.exceptions.NameResolutionError(self.host, self, e) from e
+            resolved = time.perf_counter()
+            record_http_timing('dns', resolved - start)
+            dns_host = self._dns_host
+            try:
+                # Try the addresses in order, like urllib3 does
+                for address in list(dict.fromkeys(address[4][0] for address in addresses)):
+                    self._dns_host = address
+                    try:
+                        sock = super()._new_conn()
+                        break
+                    except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError) as e:
+                        error = e
+                else:
+                    raise error
+            finally:
+                self._dns_host = dns_host
+            record_http_timing('connect', time.perf_counter() - resolved)
+            return sock
+
+        def getresponse(self, *args, **kwargs):
+            # The request has been sent at this point, so this is the time to first byte
+            start = time.perf_counter()
+            response = super().getresponse(*args, **kwargs)
+            record_http_timing('ttfb', time.perf_counter() - start)
+            return response
+
+    class TimedHTTPSConnection(TimedHTTPConnection, urllib3.connection.HTTPSConnection):
+
+        def connect(self):
+            # The TLS handshake is whatever connect does after _new_conn
+            timings = getattr(http_timing, 'timings', None)
+            before = 0 if timings == None else timings.get('dns', 0) + timings.get('connect', 0)
+            start = time.perf_counter()
+            super().connect()
+            after = 0 if timings == None else timings.get('dns', 0) + timings.get('connect', 0)
+            record_http_timing('tls', time.perf_counter() - start - (after - before))
+
+    class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+    http_retry_class = DeadlineRetry
+    http_adapter_class = TimedHTTPAdapter
+    return http_adapter_class
+
+# HTTP session shared by all the threads of the process, so that connections to the same host are kept alive
+# and reused. Sessions are not shared across a fork, each worker process creates its own
+http_session = None
+http_session_pid = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    global http_session, http_session_pid
+    # Modules are imported and classes created before taking the lock, so that it is only held for a short time
+    adapter_class = get_http_adapter_class()
+    with http_session_lock:
+        if http_session == None or http_session_pid != os.getpid():
+            # Read timeouts are not retried, so that HTTP_READ_TIMEOUT is the longest wait for an answer
+            retries = http_retry_class(total=int(get_variable_value('HTTP_RETRIES') or 2), read=0, backoff_factor=0.2,
+                                       status_forcelist=(502, 503, 504), allowed_methods=('GET', 'HEAD'), raise_on_status=False)
+            adapter = adapter_class(pool_connections=int(get_variable_value('HTTP_POOL_CONNECTIONS') or 10),
+                                    pool_maxsize=int(get_variable_value('HTTP_POOL_SIZE') or 10),
+                                    max_retries=retries)
+            http_session = requests.Session()
+            http_session.mount('http://', adapter)
+            http_session.mount('https://', adapter)
+            http_session_pid = os.getpid()
+        return http_session
+
+def get_http_timeout():
+    return (float(get_variable_value('HTTP_CONNECT_TIMEOUT') or 5), float(get_variable_value('HTTP_READ_TIMEOUT') or 30))
+
+# Send a GET request with the shared session. Returns the response and the timing breakdown in milliseconds,
+# where DNS, connect and TLS are 0 if an existing connection was reused. With max_seconds, failed attempts are not
+# retried once that time has passed
+def http_get(url, timeout=None, max_seconds=None):
+    http_timing.timings = {}
+    start = time.perf_counter()
+    http_timing.deadline = None if max_seconds == None else start + max_seconds
+    try:
+        response = get_http_session().get(url, timeout=timeout or get_http_timeout())
+        total = time.perf_counter() - start
+        timings = http_timing.timings
+    finally:
+        http_timing.timings = None
+        http_timing.deadline = None
+    retries = response.raw.retries
+    timing = {phase + '_ms': round(timings.get(phase, 0) * 1000, 3) for phase in ('dns', 'connect', 'tls', 'ttfb')}
+    timing['total_ms'] = round(total * 1000, 3)
+    timing['reused_connection'] = 'connect' not in timings
+    timing['retries'] = len(retries.history) if retries != None else 0
+    return response, timing
 
 
 # Start flask app
 app = Flask(__name__)
 
+# Prometheus metrics, kept in memory by each process and rendered in the text exposition format by /metrics.
+# Recording a value takes a lock and a dictionary update, histograms only increment the bucket where the value
+# falls (buckets are made cumulative when rendered). Each gunicorn worker process has its own metrics and a scrape
+# is answered by any of them, so the workers save their samples to the metrics directory and /metrics adds them up
+metrics_registry = []
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}        # tuple of label values -> value
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get_samples(self):
+        with self.lock:
+            return [('', label_values, value) for label_values, value in self.values.items()]
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+# Histogram with fixed buckets (upper bounds in seconds)
+class Histogram(Counter):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series == None:
+                series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += value
+
+    def get_samples(self):
+        with self.lock:
+            values = [(label_values, list(series)) for label_values, series in self.values.items()]
+        samples = []
+        for label_values, series in values:
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), series):
+                count += bucket_count
+                samples.append(('_bucket', label_values + (bound,), count))
+            samples.append(('_sum', label_values, series[-1]))
+            samples.append(('_count', label_values, count))
+        return samples
+
+# Metric whose values are read when rendering, out of function() returning a dictionary {tuple of label values: value}
+class CallbackMetric(Counter):
+
+    def __init__(self, name, help, labels, function, type='gauge'):
+        super().__init__(name, help, labels)
+        self.function = function
+        self.type = type
+
+    def get_samples(self):
+        return [('', label_values, value) for label_values, value in self.function().items()]
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def get_metrics_dir():
+    metrics_dir = get_variable_value('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'sqlapi-metrics')
+    os.makedirs(metrics_dir, exist_ok=True)
+    return metrics_dir
+
+# Metrics files are named <run id>-<pid>.json, and /metrics only adds up the files of its own run, so that other
+# instances sharing the metrics directory and previous runs are not counted. The run id is created when the module is
+# imported, and inherited by the worker processes forked by the production server. Servers that import the module in
+# each worker (gunicorn without --preload) need the same METRICS_RUN_ID in the environment of all the workers
+metrics_run_id = get_variable_value('METRICS_RUN_ID') or uuid.uuid4().hex
+
+def get_metrics_path(pid):
+    return os.path.join(get_metrics_dir(), '{0}-{1}.json'.format(metrics_run_id, pid))
+
+# Remove the files of other runs whose process has exited (called when rendering, and by the production server
+# before starting the workers)
+def prune_metrics_dir():
+    metrics_dir = get_metrics_dir()
+    for file_name in os.listdir(metrics_dir):
+        if not file_name.endswith('.json') or file_name.startswith(metrics_run_id + '-'):
+            continue
+        path = os.path.join(metrics_dir, file_name)
+        try:
+            with open(path, 'r') as file:
+                pid = json.load(file)['pid']
+            if not is_process_alive(pid):
+                os.remove(path)
+        except (ValueError, KeyError, TypeError, OSError):
+            pass
+
+# Save the samples of all the metrics of this process to <run id>-<pid>.json in the metrics directory, through a
+# temporary file (one per thread) so that readers never see it half-written
+def save_metrics():
+    samples = {}
+    for metric in metrics_registry:
+        try:
+            samples[metric.name] = [[suffix, list(label_values), value] for suffix, label_values, value in metric.get_samples()]
+        except Exception as e:
+            app.logger.error('Error collecting metric {0}: {1}'.format(metric.name, str(e)))
+    path = get_metrics_path(os.getpid())
+    temp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+    with open(temp_path, 'w') as file:
+        json.dump({'run_id': metrics_run_id, 'pid': os.getpid(), 'samples': samples}, file)
+    os.replace(temp_path, path)
+
+# Background thread saving the metrics of the process every METRICS_SAVE_INTERVAL seconds, started in each worker
+metrics_saver_pid = None
+
+def save_metrics_loop():
+    interval = float(get_variable_value('METRICS_SAVE_INTERVAL', 5))
+    while True:
+        time.sleep(interval)
+        try:
+            save_metrics()
+        except Exception as e:
+            print('Error saving metrics: ' + str(e))
+
+def start_metrics_saver():
+    global metrics_saver_pid
+    if metrics_saver_pid != os.getpid():
+        metrics_saver_pid = os.getpid()
+        threading.Thread(target=save_metrics_loop, daemon=True).start()
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+# Samples of all worker processes of this run added up by series. This process saves its samples first, the others are
+# as old as their last save (at most METRICS_SAVE_INTERVAL seconds). Counters and histograms of workers of this run that
+# have exited are still counted, so that totals do not go down when gunicorn restarts a worker, but their gauges are not
+def render_metrics():
+    save_metrics()
+    prune_metrics_dir()
+    metrics_dir = get_metrics_dir()
+    totals = {metric.name: collections.OrderedDict() for metric in metrics_registry}
+    for file_name in sorted(os.listdir(metrics_dir)):
+        if not file_name.endswith('.json') or not file_name.startswith(metrics_run_id + '-'):
+            continue
+        try:
+            with open(os.path.join(metrics_dir, file_name), 'r') as file:
+                saved = json.load(file)
+        except (ValueError, OSError):
+            continue
+        alive = is_process_alive(saved['pid'])
+        for metric in metrics_registry:
+            if metric.type == 'gauge' and not alive:
+                continue
+            series = totals[metric.name]
+            for suffix, label_values, value in saved['samples'].get(metric.name, []):
+                key = (suffix, tuple(label_values))
+                series[key] = series.get(key, 0) + value
+    lines = []
+    for metric in metrics_registry:
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+        labels = metric.labels + (('le',) if metric.type == 'histogram' else ())
+        for (suffix, label_values), value in totals[metric.name].items():
+            label_string = ','.join('{0}="{1}"'.format(label, escape_label_value(label_value)) for label, label_value in zip(labels, label_values))
+            lines.append('{0}{1}{{{2}}} {3}'.format(metric.name, suffix, label_string, float(value)))
+    return '\n'.join(lines) + '\n'
+
+# Per-request metrics, by route (the URL rule, not the URL, so that the number of series is bounded)
+http_requests_total = Counter('sqlapi_http_requests_total', 'HTTP requests served', ('route', 'method', 'status'))
+http_request_duration_seconds = Histogram('sqlapi_http_request_duration_seconds', 'Time to process HTTP requests (until the response body starts to be sent)', ('route', 'method'))
+http_requests_in_flight = Gauge('sqlapi_http_requests_in_flight', 'HTTP requests being processed')
+# Inner phases of other operations
+sql_phase_duration_seconds = Histogram('sqlapi_sql_phase_duration_seconds', 'Time spent in each phase of SQL queries (resolve, connect, execute, fetch)', ('engine', 'phase'))
+akv_fetch_duration_seconds = Histogram('sqlapi_akv_fetch_duration_seconds', 'Time to retrieve secrets from Azure Key Vault', ('result',))
+benchmark_phase_duration_seconds = Histogram('sqlapi_benchmark_phase_duration_seconds', 'Time spent in each phase of I/O benchmarks', ('phase',),
+                                             buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+
+# Metrics of the caches, pools and buffers, out of the statistics they already keep
+def get_sql_pool_values(events=False):
+    with sql_pools_lock:
+        pools = list(sql_pools.values())
+    values = {}
+    for pool in pools:
+        stats = pool.get_stats()
+        if events:
+            values.update({(stats['pool'], event): value for event, value in stats['metrics'].items()})
+        else:
+            values.update({(stats['pool'], state): stats[state] for state in ('in_use', 'idle')})
+    return values
+
+def get_stats_values(get_stats, keys):
+    metrics = get_stats()['metrics']
+    return {(key,): metrics[key] for key in keys}
+
+CallbackMetric('sqlapi_sql_pool_connections', 'Connections in the SQL connection pools, by state', ('pool', 'state'), get_sql_pool_values)
+CallbackMetric('sqlapi_sql_pool_events_total', 'Events of the SQL connection pools', ('pool', 'event'), lambda: get_sql_pool_values(events=True), type='counter')
+CallbackMetric('sqlapi_akv_cache_events_total', 'Lookups and refreshes of the Azure Key Vault secret cache', ('event',),
+               lambda: get_stats_values(akv_secret_cache.get_stats, ('hits', 'stale_hits', 'misses', 'refreshes', 'errors')), type='counter')
+CallbackMetric('sqlapi_dns_cache_events_total', 'Lookups of the DNS cache', ('event',),
+               lambda: get_stats_values(dns_cache.get_stats, ('hits', 'negative_hits', 'misses', 'evictions', 'fallbacks', 'errors')), type='counter')
+CallbackMetric('sqlapi_dns_cache_entries', 'Entries in the DNS cache', (), lambda: {(): len(dns_cache.entries)})
+CallbackMetric('sqlapi_srciplog_buffer_events_total', 'Rows and flushes of the srciplog write buffer', ('event',),
+               lambda: get_stats_values(srciplog_buffer.get_stats, ('added', 'flushed', 'flushes', 'flush_errors', 'dropped')), type='counter')
+CallbackMetric('sqlapi_srciplog_buffer_depth', 'Rows waiting in the srciplog write buffer', (), lambda: {(): srciplog_buffer.get_stats()['depth']})
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    http_requests_in_flight.inc()
+
+@app.after_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+# Runs even if the request failed with an exception (status 500 then)
+@app.teardown_request
+def record_request_metrics(exception=None):
+    start = g.pop('metrics_start', None)
+    if start == None:
+        return
+    http_requests_in_flight.dec()
+    route = request.url_rule.rule if request.url_rule != None else 'unmatched'
+    http_request_duration_seconds.observe(time.perf_counter() - start, route, request.method)
+    http_requests_total.inc(route, request.method, str(g.pop('metrics_status', 500)))
+    # The samples saved while rendering /metrics counted the scrape as in flight, save them again without it
+    if route == '/metrics':
+        try:
+            save_metrics()
+        except Exception as e:
+            app.logger.error('Error saving metrics: ' + str(e))
+
 
 # Get IP addresses of DNS servers
 def get_dns_ips():
@@ -383,7 +2299,7 @@ def get_dns_ips():
                     if is_valid_ipv4_address(ip):
                         dns_ips.append(ip)
         return dns_ips
-        my_resolver = dns.resolver.Resolver()
+        my_resolver = dns_resolver.Resolver()
         return str(my_resolver.nameservers)
     except:
         return ''
@@ -401,20 +2317,167 @@ def get_default_gateway():
     except Exception as e:
         return str(e)
 
-# Route to upload file and return file size
+# Network information of the container (public and private IP, DNS servers and default gateway). It does not change
+# often, so it is computed in a background thread every refresh_interval seconds and /api/ip serves the cached values.
+# The public IP is discovered by querying all the public_ip_urls in parallel and taking the first valid answer
+class NetworkInfo:
+
+    def __init__(self, refresh_interval=300, public_ip_urls=()):
+        self.refresh_interval = refresh_interval
+        self.public_ip_urls = list(public_ip_urls)
+        self.info = None
+        self.updated = None
+        self.refresher_pid = None
+        self.lock = threading.Lock()
+
+    # Ask the discovery URLs for our public IP, they can answer with JSON (with an 'ip' field) or plain text
+    def get_public_ip_from(self, url):
+        http_answer = http_get(url, timeout=(get_http_timeout()[0], get_http_timeout()[0]))[0]
+        http_answer.raise_for_status()
+        try:
+            public_ip = http_answer.json()['ip']
+        except Exception:
+            public_ip = http_answer.content.decode('ascii', errors='ignore').strip()
+        return str(ipaddress.ip_address(public_ip))
+
+    def get_public_ip(self):
+        if not self.public_ip_urls:
+            return None, None, 'No public IP discovery URLs configured'
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.public_ip_urls), thread_name_prefix='publicip')
+        pending = {}
+        try:
+            pending = {executor.submit(self.get_public_ip_from, url): url for url in self.public_ip_urls}
+            errors = []
+            while pending:
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    try:
+                        return future.result(), url, None
+                    except Exception as e:
+                        errors.append(url + ': ' + str(e))
+            return None, None, '; '.join(errors)
+        finally:
+            # shutdown has no cancel_futures before Python 3.9 (the image has Python 3.8), so they are cancelled here
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def refresh(self):
+        public_ip, public_ip_source, public_ip_error = self.get_public_ip()
+        info = {
+            'my_private_ip': str(get_ip(socket.gethostname())),
+            'my_dns_servers': str(get_dns_ips()),
+            'my_default_gateway': str(get_default_gateway()),
+            'my_public_ip': public_ip,
+            'my_public_ip_source': public_ip_source
+        }
+        with self.lock:
+            # If no discovery URL answered (for example when egress traffic is blocked) keep the last known public IP
+            if public_ip == None and self.info != None and self.info['my_public_ip'] != None:
+                info['my_public_ip'] = self.info['my_public_ip']
+                info['my_public_ip_source'] = self.info['my_public_ip_source']
+            if public_ip_error != None:
+                info['my_public_ip_error'] = public_ip_error
+            self.info = info
+            self.updated = time.time()
+        return info
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print('Error refreshing network information: ' + str(e))
+
+    # Start the refresher thread (again if the process has been forked), the first refresh happens in the background too
+    def start_refresher(self):
+        if self.refresher_pid != os.getpid():
+            if self.refresher_pid != None:
+                self.lock = threading.Lock()
+            self.refresher_pid = os.getpid()
+            threading.Thread(target=self.refresh, daemon=True).start()
+            threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+    # Returns the cached information and its age in seconds. It is refreshed synchronously if it is missing,
+    # if refresh is True, or if it is too old because no refresher thread is running in this process
+    def get(self, refresh=False):
+        with self.lock:
+            info, updated = self.info, self.updated
+        if refresh or info == None or (self.refresher_pid != os.getpid() and time.time() - updated > self.refresh_interval):
+            info = self.refresh()
+            with self.lock:
+                updated = self.updated
+        return dict(info), round(time.time() - updated, 1)
+
+network_info = NetworkInfo(refresh_interval=int(get_variable_value('NETINFO_REFRESH_INTERVAL') or 300),
+                           public_ip_urls=[url.strip() for url in (get_variable_value('PUBLIC_IP_URLS') or 'http://jsonip.com,https://api.ipify.org?format=json,https://ifconfig.co/json').split(',') if url.strip()])
+
+# Read a stream in chunks of a fixed size (so that memory usage does not depend on the stream size),
+# returning its size, throughput, time to first byte and optionally SHA-256 and/or CRC32 checksums
+def measure_stream(stream, chunk_size, hash_algorithms=()):
+    for algorithm in hash_algorithms:
+        if algorithm not in ('sha256', 'crc32'):
+            raise ValueError('Hash algorithm ' + algorithm + ' not supported, use sha256 and/or crc32')
+    sha256 = hashlib.sha256() if 'sha256' in hash_algorithms else None
+    crc32 = 0
+    size = 0
+    chunks = 0
+    first_byte = None
+    start = time.perf_counter()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if first_byte == None:
+            first_byte = time.perf_counter()
+        size += len(chunk)
+        chunks += 1
+        if sha256:
+            sha256.update(chunk)
+        if 'crc32' in hash_algorithms:
+            crc32 = zlib.crc32(chunk, crc32)
+    duration = time.perf_counter() - start
+    result = {
+        'size': size,
+        'chunks': chunks,
+        'chunk_size': chunk_size,
+        'duration_sec': round(duration, 3),
+        'throughput_mib_per_sec': round(size / 1024 / 1024 / duration, 2) if duration > 0 else None,
+        'time_to_first_byte_ms': round((first_byte - start) * 1000, 3) if first_byte != None else None
+    }
+    if sha256:
+        result['sha256'] = sha256.hexdigest()
+    if 'crc32' in hash_algorithms:
+        result['crc32'] = '{0:08x}'.format(crc32)
+    return result
+
+# Route to upload file and return file size. The file can be sent either as the field "data" of a
+# multipart form, or as the raw body of the request with the content type application/octet-stream
 @app.route('/api/filesize', methods=['POST'])
 def getsize():
     try:
-      uploaded_file = request.files['data']
-      if uploaded_file:
-          f = uploaded_file.read()
-          msg = {
-             'size': len(f)
-          }
+      chunk_size = int(request.args.get('chunksize') or get_variable_value('FILESIZE_CHUNK_KB', 1024)) * 1024
+      hash_algorithms = [algorithm.strip().lower() for algorithm in (request.args.get('hash') or '').split(',') if algorithm.strip()]
+      if request.mimetype == 'application/octet-stream':
+          # The body is read straight from the socket, without being buffered anywhere
+          msg = measure_stream(request.stream, chunk_size, hash_algorithms)
       else:
-         msg = {
-             'size': 'unknown'
-         }
+          # Parsing the form reads the whole body from the network and spools the file to memory or to a temporary file,
+          # so throughput is measured while parsing, and the time to first byte is not known
+          start = time.perf_counter()
+          uploaded_file = request.files['data']
+          duration = time.perf_counter() - start
+          if uploaded_file:
+              msg = measure_stream(uploaded_file.stream, chunk_size, hash_algorithms)
+              msg['duration_sec'] = round(duration, 3)
+              msg['throughput_mib_per_sec'] = round(msg['size'] / 1024 / 1024 / duration, 2) if duration > 0 else None
+              msg['time_to_first_byte_ms'] = None
+          else:
+             msg = {
+                 'size': 'unknown'
+             }
       return jsonify(msg)
     except Exception as e:
         return jsonify(str(e))
@@ -427,6 +2490,17 @@ def ioperf():
         SIZE = 128
         WRITE_BLOCK_SIZE = 128
         READ_BLOCK_SIZE = 8
+        IODEPTH = 1
+        NUMJOBS = 1
+        SHARED_FILE = True
+        WRITE_PATTERN = 'sequential'
+        READ_PATTERN = 'random'
+        RWMIXREAD = None
+        DIRECT = False
+        FSYNC = 1
+        DROP_CACHE = False
+        BUFFER_POOL = False
+        MUTATE_HEADERS = True
         try:
             if request.args.get('file'):
                 FILE = urllib.parse.unquote(request.args.get('file'))
@@ -436,14 +2510,93 @@ def ioperf():
                 WRITE_BLOCK_SIZE = int(request.args.get('writeblocksize'))
             if request.args.get('readblocksize'):
                 READ_BLOCK_SIZE = int(request.args.get('readblocksize'))
-            app.logger.info("Running I/O benchmark on file {0}, size {1}MB, write block size {2}KB and read block size {3}KB...".format(FILE, str(SIZE), str(WRITE_BLOCK_SIZE), str(READ_BLOCK_SIZE)))
-            benchmark = Benchmark(FILE, SIZE, WRITE_BLOCK_SIZE, READ_BLOCK_SIZE)
+            if request.args.get('iodepth'):
+                IODEPTH = int(request.args.get('iodepth'))
+            if request.args.get('numjobs'):
+                NUMJOBS = int(request.args.get('numjobs'))
+            if request.args.get('sharedfile'):
+                SHARED_FILE = (request.args.get('sharedfile') == 'yes')
+            if request.args.get('writepattern'):
+                WRITE_PATTERN = request.args.get('writepattern')
+            if request.args.get('readpattern'):
+                READ_PATTERN = request.args.get('readpattern')
+            if request.args.get('rwmixread'):
+                RWMIXREAD = int(request.args.get('rwmixread'))
+            if request.args.get('direct'):
+                DIRECT = (request.args.get('direct') == 'yes')
+            if request.args.get('fsync'):
+                FSYNC = int(request.args.get('fsync'))
+            if request.args.get('dropcache'):
+                DROP_CACHE = (request.args.get('dropcache') == 'yes')
+            if request.args.get('bufferpool'):
+                BUFFER_POOL = (request.args.get('bufferpool') == 'yes')
+            if request.args.get('mutateheaders'):
+                MUTATE_HEADERS = (request.args.get('mutateheaders') == 'yes')
+            if WRITE_PATTERN not in ('sequential', 'random') or READ_PATTERN not in ('sequential', 'random'):
+                return jsonify('writepattern and readpattern can be either sequential or random')
+            if RWMIXREAD != None and (RWMIXREAD < 0 or RWMIXREAD > 100):
+                return jsonify('rwmixread needs to be a percentage between 0 and 100')
+            max_threads = int(get_variable_value('IOPERF_MAX_THREADS', 256))
+            if IODEPTH < 1 or NUMJOBS < 1 or IODEPTH * NUMJOBS > max_threads:
+                return jsonify('iodepth and numjobs need to be at least 1, and iodepth x numjobs at most {0}'.format(max_threads))
+            params = {'file': FILE, 'size': SIZE, 'writeblocksize': WRITE_BLOCK_SIZE, 'readblocksize': READ_BLOCK_SIZE,
+                      'iodepth': IODEPTH, 'numjobs': NUMJOBS, 'sharedfile': SHARED_FILE,
+                      'writepattern': WRITE_PATTERN, 'readpattern': READ_PATTERN, 'rwmixread': RWMIXREAD,
+                      'direct': DIRECT, 'fsync': FSYNC, 'dropcache': DROP_CACHE,
+                      'bufferpool': BUFFER_POOL, 'mutateheaders': MUTATE_HEADERS}
+            # With async=yes the benchmark runs in the background, and its progress can be checked with /api/ioperfjob
+            if request.args.get('async') == 'yes':
+                job = submit_ioperf_job(params)
+                app.logger.info("Submitted I/O benchmark job {0} on file {1}, size {2}MB".format(job.id, FILE, str(SIZE)))
+                msg = {
+                    'job_id': job.id,
+                    'state': job.state,
+                    'status_url': '/api/ioperfjob?id=' + job.id,
+                    'cancel_url': '/api/ioperfcancel?id=' + job.id
+                }
+                return jsonify(msg), 202
+            app.logger.info("Running I/O benchmark on file {0}, size {1}MB, write block size {2}KB, read block size {3}KB, {4} jobs and I/O depth {5}...".format(FILE, str(SIZE), str(WRITE_BLOCK_SIZE), str(READ_BLOCK_SIZE), str(NUMJOBS), str(IODEPTH)))
+            benchmark = create_benchmark(params)
             benchmark_result = benchmark.get_json_result()
             return jsonify(benchmark_result)
 
         except Exception as e:
             return jsonify(str(e))
 
+# Return the status, progress and results of a background I/O benchmark job, or a list of all jobs if no id is supplied
+@app.route('/api/ioperfjob', methods=['GET'])
+def ioperfjob():
+    if request.method == 'GET':
+        try:
+            job_id = request.args.get('id')
+            if job_id == None:
+                msg = {
+                    'jobs': [{'job_id': status['job_id'], 'state': status['state'], 'params': status['params']} for status in get_ioperf_job_statuses()]
+                }
+                return jsonify(msg)
+            status = get_ioperf_job_status(job_id)
+            if status == None:
+                return jsonify('Job ' + job_id + ' not found'), 404
+            return jsonify(status)
+        except Exception as e:
+            return jsonify(str(e))
+
+# Cancel a background I/O benchmark job
+@app.route('/api/ioperfcancel', methods=['GET', 'POST'])
+def ioperfcancel():
+    try:
+        job_id = request.args.get('id')
+        status = cancel_ioperf_job(job_id)
+        if status == None:
+            return jsonify('Job ' + str(job_id) + ' not found'), 404
+        msg = {
+            'job_id': status['job_id'],
+            'state': status['state']
+        }
+        return jsonify(msg)
+    except Exception as e:
+        return jsonify(str(e))
+
 # Flask route for healthchecks
 @app.route("/api/healthcheck", methods=['GET'])
 def healthcheck():
@@ -469,6 +2622,15 @@ def sql():
             sql_engine = request.args.get('SQL_ENGINE')
             use_ssl = request.args.get('USE_SSL')
             sql_query = request.args.get('QUERY')
+            # format=ndjson returns the complete result set, streamed as it is fetched
+            if request.args.get('format') == 'ndjson':
+                if sql_query == None:
+                    return jsonify('The parameter QUERY is required with format=ndjson')
+                limit = int(request.args.get('limit') or get_variable_value('SQL_ROW_LIMIT') or 100000)
+                batch_size = int(request.args.get('batchsize') or get_variable_value('SQL_FETCH_BATCH') or 500)
+                send_args = {'sql_server_fqdn': sql_server_fqdn, 'sql_server_db': sql_server_db, 'sql_server_username': sql_server_username,
+                             'sql_server_password': sql_server_password, 'sql_engine': sql_engine, 'use_ssl': use_ssl}
+                return Response(stream_sql_query(send_args, sql_query, limit, batch_size), mimetype='application/x-ndjson')
             sql_output = send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username, sql_server_password=sql_server_password, sql_query=sql_query, sql_engine=sql_engine, use_ssl=use_ssl)
             msg = {
                 'sql_output': sql_output
@@ -477,6 +2639,95 @@ def sql():
         except Exception as e:
           return jsonify(str(e))
 
+# Cursor that streams the rows from the server as they are fetched, instead of reading the whole result set when the
+# query is executed: unbuffered cursor for MySQL, named (server-side) cursor for Postgres. ODBC and SQLite cursors
+# already fetch rows on demand
+def get_streaming_cursor(cx, sql_engine):
+    if sql_engine == 'mysql':
+        return cx.cursor(pymysql.cursors.SSCursor)
+    if sql_engine == 'postgres':
+        return cx.cursor(name='api_sql_' + uuid.uuid4().hex)
+    return cx.cursor()
+
+# JSON representation of the values that the JSON encoder does not know (dates, decimals, UUIDs, binary data)
+def sql_value_to_json(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+def format_sql_rows(rows):
+    return ''.join(json.dumps(list(row), default=sql_value_to_json) + '\n' for row in rows)
+
+# Run a query and stream its result set as NDJSON: a first line with the column names, one line per row (a list of
+# values) and a last line with the number of rows (or with the error). The query runs in a pooled connection in
+# another thread, which fetches batch_size rows at a time and hands them over through a small queue, so only a few
+# batches are in memory regardless of the size of the result set. At most limit rows are returned
+def stream_sql_query(send_args, sql_query, limit, batch_size):
+    batches = queue.Queue(maxsize=2)
+    cancelled = threading.Event()
+
+    # Returns False if the client has gone away
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_rows(cx, sql_engine):
+        start = time.perf_counter()
+        cursor = get_streaming_cursor(cx, sql_engine)
+        cursor.execute(sql_query)
+        rows = cursor.fetchmany(batch_size)
+        put({'columns': [column[0] for column in cursor.description] if cursor.description else []})
+        count = 0
+        truncated = False
+        while rows:
+            if count + len(rows) > limit:
+                rows = rows[:limit - count]
+                truncated = True
+            count += len(rows)
+            if not put(rows):
+                break
+            if count >= limit:
+                truncated = truncated or bool(cursor.fetchmany(1))
+                break
+            rows = cursor.fetchmany(batch_size)
+        if sql_engine == 'mysql' and (truncated or cancelled.is_set()):
+            # Closing an unbuffered cursor reads the rest of the result set, the connection is closed instead (and
+            # discarded by the pool)
+            cx.close()
+        else:
+            cursor.close()
+        return {'rows': count, 'truncated': truncated, 'elapsed_ms': round((time.perf_counter() - start) * 1000, 3)}
+
+    def produce():
+        try:
+            # Named cursors of Postgres only exist within a transaction
+            result = send_sql_query(sql_query=sql_query, sql_function=fetch_rows, transaction=True, **send_args)
+            # send_sql_query returns an error message if it cannot connect
+            put(result if isinstance(result, dict) else {'error': str(result)})
+        except Exception as e:
+            put({'error': str(e)})
+        put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = batches.get()
+            if item == None:
+                break
+            if isinstance(item, dict):
+                yield json.dumps(item) + '\n'
+            else:
+                yield format_sql_rows(item)
+    finally:
+        cancelled.set()
+
 # Flask route to ping the SQL server with a basic SQL query
 @app.route("/api/sqlversion", methods=['GET'])
 def sqlversion():
@@ -548,22 +2799,15 @@ def sqlsrcipinit():
                     sql_engine = 'sqlserver'
             else:
                 sql_engine = request.args.get('SQL_ENGINE')
-            # Select the right query for the src IP depending on the DB engine
-            if sql_engine == 'sqlserver':
-                sql_query = 'CREATE TABLE srciplog (ip varchar(15), timestamp varchar(30));'
-            elif sql_engine == 'mysql':
-                sql_query = 'CREATE TABLE srciplog (ip varchar(15), timestamp varchar(30));'
-            elif sql_engine == 'postgres':
-                sql_query = 'CREATE TABLE srciplog (ip varchar(15), timestamp varchar(30));'
+            if sql_engine not in srciplog_queries:
+                return jsonify('DB engine ' + str(sql_engine) + ' not supported')
 
-            # Send query to retrieve source IP
+            # Create the tables (migrating the data of an existing srciplog table with the old schema)
             app.logger.info('Values retrieved from the query: {0}, db {1}: credentials {2}/{3}'.format(str(sql_server_fqdn), str(sql_server_db), str(sql_server_username), str(sql_server_password)))
-            sql_output = send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username, sql_server_password=sql_server_password, sql_query=sql_query, sql_engine=sql_engine)
-
-            msg = {
-            'table_created': 'srciplog'
-            }          
-            return jsonify(msg)
+            sql_output = send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username, sql_server_password=sql_server_password, sql_engine=sql_engine, use_ssl=use_ssl, sql_function=init_srciplog, transaction=True)
+            if not isinstance(sql_output, dict):
+                return jsonify({'sql_output': sql_output})
+            return jsonify(sql_output)
         except Exception as e:
           return jsonify(str(e))
 
@@ -584,6 +2828,8 @@ def sqlsrciplog():
                     sql_engine = 'sqlserver'
             else:
                 sql_engine = request.args.get('SQL_ENGINE')
+            if sql_engine not in srciplog_queries:
+                return jsonify('DB engine ' + str(sql_engine) + ' not supported')
 
             # Select the right query for the src IP depending on the DB engine
             if sql_engine == 'sqlserver':
@@ -596,38 +2842,179 @@ def sqlsrciplog():
             app.logger.info('Values retrieved from the query: {0}, db {1}: credentials {2}/{3}'.format(str(sql_server_fqdn), str(sql_server_db), str(sql_server_username), str(sql_server_password)))
             src_ip_address = str(send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username, sql_server_password=sql_server_password, sql_query=sql_query, sql_engine=sql_engine))
 
-            # Send query to record IP in the srciplog table
-            timestamp = str(datetime.datetime.utcnow())
-            if sql_engine == 'sqlserver':
-                sql_query = "INSERT INTO srciplog (ip, timestamp) VALUES ('{0}', '{1}');".format(src_ip_address, timestamp)
-            elif sql_engine == 'mysql':
-                sql_query = "INSERT INTO srciplog (ip, timestamp) VALUES ('{0}', '{1}');".format(src_ip_address, timestamp)
-            elif sql_engine == 'postgres':
-                sql_query = "INSERT INTO srciplog (ip, timestamp) VALUES ('{0}', '{1}');".format(src_ip_address, timestamp)
-            # Send query to retrieve source IP
-            app.logger.info('Values retrieved from the query: {0}, db {1}: credentials {2}/{3}'.format(str(sql_server_fqdn), str(sql_server_db), str(sql_server_username), str(sql_server_password)))
-            sql_output = send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username, sql_server_password=sql_server_password, sql_query=sql_query, sql_engine=sql_engine)
+            # MySQL returns the source as ip:port, anything that is not an IP address is an error message
+            try:
+                src_ip_address = str(ipaddress.ip_address(src_ip_address))
+            except ValueError:
+                try:
+                    src_ip_address = str(ipaddress.ip_address(src_ip_address.rsplit(':', 1)[0].strip('[]')))
+                except ValueError:
+                    return jsonify(src_ip_address)
+
+            # Record IP in the srciplog table: the row is buffered and written in a batch by a background thread
+            timestamp = datetime.datetime.utcnow()
+            timestamp = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+            target = (sql_server_fqdn, sql_server_db, sql_server_username, sql_server_password, sql_engine, use_ssl)
+            srciplog_buffer.add(target, (src_ip_address, timestamp))
 
             msg = {
             'srciplog': {
                 'ip': src_ip_address,
-                'timestamp': timestamp
-                }
-            }          
+                'timestamp': str(timestamp)
+                },
+            'buffered': True
+            }
+            # The parameter flush=yes writes the buffered rows before answering
+            if request.args.get('flush') == 'yes':
+                msg['rows_written'] = srciplog_buffer.flush()
             return jsonify(msg)
         except Exception as e:
           return jsonify(str(e))
 
 
+# Returns the number of connections logged per source IP in the last minutes (60 per default), out of the rollup table
+@app.route("/api/sqlsrcipstats", methods=['GET'])
+def sqlsrcipstats():
+    if request.method == 'GET':
+        try:
+            # Get variables from the request
+            sql_server_fqdn = request.args.get('SQL_SERVER_FQDN')
+            sql_server_db = request.args.get('SQL_SERVER_DB')
+            sql_server_username = request.args.get('SQL_SERVER_USERNAME')
+            sql_server_password = request.args.get('SQL_SERVER_PASSWORD')
+            use_ssl = request.args.get('USE_SSL')
+            if request.args.get('SQL_ENGINE') == None:
+                sql_engine = get_variable_value('SQL_ENGINE')
+                if sql_engine == None:
+                    sql_engine = 'sqlserver'
+            else:
+                sql_engine = request.args.get('SQL_ENGINE')
+            if sql_engine not in srciplog_queries:
+                return jsonify('DB engine ' + str(sql_engine) + ' not supported')
+            minutes = int(request.args.get('minutes') or 60)
+            since = datetime.datetime.utcnow().replace(second=0, microsecond=0) - datetime.timedelta(minutes=minutes)
+            sql_output = send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username, sql_server_password=sql_server_password, sql_engine=sql_engine, use_ssl=use_ssl,
+                                        sql_function=lambda cx, sql_engine: get_srciplog_stats(cx, sql_engine, since))
+            if not isinstance(sql_output, list):
+                return jsonify({'sql_output': sql_output})
+            msg = {
+                'minutes': minutes,
+                'since': str(since),
+                'total_hits': sum(row['hits'] for row in sql_output),
+                'ips': sql_output
+            }
+            return jsonify(msg)
+        except Exception as e:
+          return jsonify(str(e))
+
+# Runs count queries one after the other in a connection, with interval seconds between them, and appends the latency
+# of each query in nanoseconds (execution and fetching of the results) to samples
+def run_sql_ping(cx, sql_query, count, interval, samples):
+    cursor = cx.cursor()
+    try:
+        for i in range(count):
+            if i > 0 and interval > 0:
+                time.sleep(interval)
+            start = time.perf_counter_ns()
+            cursor.execute(sql_query)
+            cursor.fetchall()
+            samples.append(time.perf_counter_ns() - start)
+    finally:
+        cursor.close()
+    return len(samples)
+
+# Jitter in microseconds: mean difference between the latencies of consecutive queries in the same connection
+def get_jitter(samples_per_connection):
+    differences = [abs(samples[i] - samples[i - 1]) for samples in samples_per_connection for i in range(1, len(samples))]
+    return round(sum(differences) / len(differences) / 1000, 1) if differences else None
+
+# Measures the SQL round-trip time: opens a new connection (not pooled, so that the login time is measured separately)
+# and sends count lightweight queries through it. With concurrency N, N connections send their share of the queries
+# in parallel. Returns the connect time of each connection, and the latency percentiles and jitter of the queries
+@app.route("/api/sqlping", methods=['GET'])
+def sqlping():
+    if request.method == 'GET':
+        try:
+            sql_server_fqdn = request.args.get('SQL_SERVER_FQDN')
+            sql_server_db = request.args.get('SQL_SERVER_DB')
+            sql_server_username = request.args.get('SQL_SERVER_USERNAME')
+            sql_server_password = request.args.get('SQL_SERVER_PASSWORD')
+            use_ssl = request.args.get('USE_SSL')
+            sql_engine = request.args.get('SQL_ENGINE')
+            sql_query = request.args.get('QUERY') or 'SELECT 1'
+            count = int(request.args.get('count') or 100)
+            concurrency = int(request.args.get('concurrency') or 1)
+            interval = float(request.args.get('interval') or 0) / 1000
+            max_count = int(get_variable_value('SQLPING_MAX_COUNT') or 10000)
+            max_concurrency = int(get_variable_value('SQLPING_MAX_CONCURRENCY') or 32)
+            if count < 1 or count > max_count or concurrency < 1 or concurrency > max_concurrency or concurrency > count:
+                return jsonify('count needs to be between 1 and {0}, and concurrency between 1 and {1} (and not higher than count)'.format(max_count, max_concurrency))
+            samples = [[] for connection in range(concurrency)]
+            connect_times = [None] * concurrency
+            setup_times = [None] * concurrency
+            results = [None] * concurrency
+
+            def ping(connection):
+                start = time.perf_counter()
+                # The connection is ready when the SQL function is called. The driver connect time is recorded in this
+                # thread by UnpooledConnections, the rest went to the connection parameters (Key Vault, driver import)
+                def sql_function(cx, sql_engine):
+                    connect_times[connection] = sql_connect_timing.seconds
+                    setup_times[connection] = time.perf_counter() - start - sql_connect_timing.seconds
+                    return run_sql_ping(cx, sql_query, count // concurrency + (1 if connection < count % concurrency else 0), interval, samples[connection])
+                try:
+                    results[connection] = send_sql_query(sql_server_fqdn=sql_server_fqdn, sql_server_db=sql_server_db, sql_server_username=sql_server_username,
+                                                         sql_server_password=sql_server_password, sql_engine=sql_engine, use_ssl=use_ssl,
+                                                         sql_function=sql_function, pooled=False)
+                except Exception as e:
+                    results[connection] = str(e)
+
+            start = time.perf_counter()
+            threads = [threading.Thread(target=ping, args=(connection,)) for connection in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            # send_sql_query returns an error message if it cannot connect, and the SQL function the number of queries
+            errors = [result for result in results if not isinstance(result, int)]
+            all_samples = [sample for connection_samples in samples for sample in connection_samples]
+            msg = {
+                'query': sql_query,
+                'count': count,
+                'concurrency': concurrency,
+                'interval_ms': interval * 1000,
+                'connect_ms': [round(connect_time * 1000, 3) for connect_time in connect_times if connect_time != None],
+                'setup_ms': [round(setup_time * 1000, 3) for setup_time in setup_times if setup_time != None],
+                'queries': len(all_samples),
+                'queries_per_second': round(len(all_samples) / elapsed, 1) if elapsed > 0 else None,
+                'latency_us': get_latency_stats(all_samples),
+                'jitter_us': get_jitter(samples),
+                'total_ms': round(elapsed * 1000, 3)
+            }
+            if errors:
+                msg['errors'] = errors
+            return jsonify(msg)
+        except Exception as e:
+            return jsonify(str(e))
+
 # Flask route to return the number PI
 @app.route("/api/pi", methods=['GET'])
 def pi():
     try:
-        DIGITS = int(request.args.get('digits'))
+        DIGITS = request.args.get('digits')
         if DIGITS == None:
             DIGITS = 10000
-        digits = [str(n) for n in list(pi_digits(DIGITS))]
-        pi_str = "%s.%s" % (digits.pop(0), "".join(digits))
+        DIGITS = int(DIGITS)
+        # The old spigot algorithm can be selected with algorithm=spigot
+        ALGORITHM = request.args.get('algorithm') or 'chudnovsky'
+        if ALGORITHM == 'spigot':
+            digits = [str(n) for n in list(pi_digits(DIGITS))]
+            pi_str = "%s.%s" % (digits.pop(0), "".join(digits))
+        elif ALGORITHM == 'chudnovsky':
+            pi_str = pi_chudnovsky(DIGITS)
+        else:
+            return jsonify('Algorithm ' + ALGORITHM + ' not supported, use chudnovsky or spigot')
         msg = {
                 'pi': pi_str
         }          
@@ -640,11 +3027,22 @@ def pi():
 def dns():
     try:
         fqdn = request.args.get('fqdn')
-        ip = get_ip(fqdn)
+        # The parameter type=AAAA resolves IPv6 addresses, nocache=yes bypasses the DNS cache
+        record_type = request.args.get('type') or 'A'
+        answer = dns_cache.resolve(fqdn, record_type, nocache=(request.args.get('nocache') == 'yes'))
         msg = {
                 'fqdn': fqdn,
-                'ip': ip
-        }          
+                'ip': answer['addresses'][0] if answer['addresses'] else False,
+                'addresses': answer['addresses'],
+                'type': answer['type'],
+                'source': answer['source'],
+                'nameserver': answer['nameserver'],
+                'ttl': answer['ttl'],
+                'cached': answer['cached'],
+                'lookup_ms': answer['lookup_ms']
+        }
+        if 'error' in answer:
+            msg['error'] = answer['error']
         return jsonify(msg)
     except Exception as e:
         return jsonify(str(e))
@@ -654,24 +3052,38 @@ def dns():
 def reversedns():
     try:
         ip = request.args.get('ip')
-        fqdn = reverse_dns(ip)
+        answer = dns_cache.resolve(ip, 'PTR', nocache=(request.args.get('nocache') == 'yes'))
         msg = {
                 'ip': ip,
-                'fqdn': fqdn
-        }          
+                'fqdn': (answer['addresses'][0], answer['addresses'][1:], [ip]) if answer['addresses'] else False,
+                'source': answer['source'],
+                'nameserver': answer['nameserver'],
+                'ttl': answer['ttl'],
+                'cached': answer['cached'],
+                'lookup_ms': answer['lookup_ms']
+        }
+        if 'error' in answer:
+            msg['error'] = answer['error']
         return jsonify(msg)
     except Exception as e:
         return jsonify(str(e))
 
+# Flask route to show the contents and metrics of the DNS cache
+@app.route("/api/dnscache", methods=['GET'])
+def dnscache():
+    if request.method == 'GET':
+        try:
+            return jsonify(dns_cache.get_stats())
+        except Exception as e:
+            return jsonify(str(e))
+
 # Flask route to provide the container's IP address
 @app.route("/api/ip", methods=['GET'])
 def ip():
     if request.method == 'GET':
         try:
-            # url = 'http://ifconfig.co/json'
-            url = 'http://jsonip.com'
-            mypip_json = requests.get(url).json()
-            mypip = mypip_json['ip']
+            # Public and private IP, DNS servers and default gateway are refreshed in the background, refresh=yes forces a refresh
+            netinfo, netinfo_age = network_info.get(refresh=(request.args.get('refresh') == 'yes'))
             if request.headers.getlist("X-Forwarded-For"):
                 try:
                     forwarded_for = str(request.headers.getlist("X-Forwarded-For"))
@@ -688,22 +3100,18 @@ def ip():
                 forwarded_for = None
             sql_server_fqdn = get_variable_value('SQL_SERVER_FQDN')
             sql_server_ip = get_ip(sql_server_fqdn)
-            app.logger.info('Getting our private IP address...')
-            myip    = str(get_ip(socket.gethostname()))
-            app.logger.info('Getting DNS servers IP addresses...')
-            dns_ips = str(get_dns_ips())
-            app.logger.info('Getting Default Gateway IP address...')
-            def_gwy = str(get_default_gateway())
             app.logger.info('Gettting environment variables HTTP_HOST and PATH_INFO...')
             rem_add = str(request.environ.get('REMOTE_ADDR', ''))
             app.logger.info('Gettting environment variable REMOTE_ADDR...')
             path    = str(request.environ['HTTP_HOST']) + str(request.environ['PATH_INFO'])
             app.logger.info('Crafting response message...')
             msg = {
-                'my_private_ip': myip,
-                'my_public_ip': mypip,
-                'my_dns_servers': dns_ips,
-                'my_default_gateway': def_gwy,
+                'my_private_ip': netinfo['my_private_ip'],
+                'my_public_ip': netinfo['my_public_ip'],
+                'my_public_ip_source': netinfo['my_public_ip_source'],
+                'my_dns_servers': netinfo['my_dns_servers'],
+                'my_default_gateway': netinfo['my_default_gateway'],
+                'network_info_age': netinfo_age,
                 'your_address': rem_add,
                 'x-forwarded-for': forwarded_for,
                 'host': host_header,
@@ -712,7 +3120,9 @@ def ip():
                 'your_browser': str(request.user_agent.browser),
                 'sql_server_fqdn': str(sql_server_fqdn),
                 'sql_server_ip': str(sql_server_ip)
-            }          
+            }
+            if 'my_public_ip_error' in netinfo:
+                msg['my_public_ip_error'] = netinfo['my_public_ip_error']
             return jsonify(msg)
         except Exception as e:
             if msg:
@@ -736,17 +3146,15 @@ def akvsecret():
         try:
             akv_name = request.args.get('akvname')
             akv_secret_name = request.args.get('akvsecret')
-            akv_uri = f"https://{akv_name}.vault.azure.net"
-            app.logger.info('Authenticating to Azure...')
-            azure_credential = DefaultAzureCredential()
-            app.logger.info('Creating AKV client...')
-            akv_client = SecretClient(vault_url=akv_uri, credential=azure_credential)
-            app.logger.info('Getting secret value from AKV...')
-            akv_secret = akv_client.get_secret(akv_secret_name)
+            # The parameter nocache=yes forces a new retrieval from Azure Key Vault
+            if request.args.get('nocache') == 'yes':
+                akv_secret_value = akv_secret_cache.fetch(akv_name, akv_secret_name)
+            else:
+                akv_secret_value = akv_secret_cache.get_secret(akv_name, akv_secret_name)
             msg = {
                 'akv_name': akv_name,
                 'akv_secret_name': akv_secret_name,
-                'akv_secret_value': str(akv_secret.value)
+                'akv_secret_value': str(akv_secret_value)
             }
             return jsonify(msg)
         except Exception as e:
@@ -760,16 +3168,153 @@ def curl():
             url = request.args.get('url')
             if url == None:
                 url='http://jsonip.com'
-            http_answer = requests.get(url).text
+            http_answer, timing = http_get(url)
             msg = {
                 'url': url,
                 'method': 'GET',
-                'answer': http_answer
+                'status_code': http_answer.status_code,
+                'timing': timing,
+                'answer': http_answer.text
             }          
             return jsonify(msg)
         except Exception as e:
             return jsonify(str(e))
 
+# Probes run by /api/probe, each one gets the probe definition and the timeout in seconds
+def probe_dns(probe, timeout):
+    answer = dns_cache.resolve(probe['target'], probe.get('recordtype', 'A'), nocache=probe.get('nocache', False))
+    if not answer['addresses']:
+        raise Exception(answer.get('error', 'Could not resolve ' + probe['target']))
+    return {'ip': answer['addresses'][0], 'addresses': answer['addresses'], 'nameserver': answer['nameserver'], 'cached': answer['cached']}
+
+def probe_rdns(probe, timeout):
+    answer = dns_cache.resolve(probe['target'], 'PTR', nocache=probe.get('nocache', False))
+    if not answer['addresses']:
+        raise Exception(answer.get('error', 'Could not reverse resolve ' + probe['target']))
+    return {'fqdn': answer['addresses'][0], 'nameserver': answer['nameserver'], 'cached': answer['cached']}
+
+def probe_http(probe, timeout):
+    http_answer, timing = http_get(probe['target'], timeout=(timeout, timeout), max_seconds=timeout)
+    return {
+        'status_code': http_answer.status_code,
+        'size': len(http_answer.content),
+        'timing': timing
+    }
+
+def probe_tcp(probe, timeout):
+    host, port = probe['target'].rsplit(':', 1)
+    host = host.strip('[]')
+    with socket.create_connection((host, int(port)), timeout=timeout) as s:
+        return {'local_address': s.getsockname()[0], 'remote_address': s.getpeername()[0]}
+
+def probe_sql(probe, timeout):
+    sql_output = send_sql_query(sql_server_fqdn=probe.get('target'), sql_server_db=probe.get('SQL_SERVER_DB'),
+                                sql_server_username=probe.get('SQL_SERVER_USERNAME'), sql_server_password=probe.get('SQL_SERVER_PASSWORD'),
+                                sql_query=probe.get('QUERY'), sql_engine=probe.get('SQL_ENGINE'), use_ssl=probe.get('USE_SSL'))
+    return {'sql_output': sql_output}
+
+probe_functions = {
+    'dns': probe_dns,
+    'rdns': probe_rdns,
+    'http': probe_http,
+    'tcp': probe_tcp,
+    'sql': probe_sql
+}
+
+# Probes of all requests share a bounded thread pool, so that a big batch does not create hundreds of threads
+probe_executor = None
+probe_executor_lock = threading.Lock()
+
+def get_probe_executor():
+    global probe_executor
+    with probe_executor_lock:
+        if probe_executor == None:
+            probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(get_variable_value('PROBE_MAX_WORKERS', 32)), thread_name_prefix='probe')
+        return probe_executor
+
+# Runs in the pool, start and end times are recorded so that neither the timeout nor the reported duration
+# include the time spent in the queue
+def run_probe(probe, timeout, timing):
+    timing[0] = time.perf_counter()
+    try:
+        return probe_functions[probe['type']](probe, timeout)
+    finally:
+        timing[1] = time.perf_counter()
+
+def get_probe_result(index, probe, status, duration, result=None, error=None):
+    probe_result = {
+        'index': index,
+        'type': probe['type'],
+        'target': probe['target'],
+        'status': status,
+        'duration_ms': round(duration * 1000, 3)
+    }
+    if result != None:
+        probe_result.update(result)
+    if error != None:
+        probe_result['error'] = error
+    return probe_result
+
+# Run the probes concurrently and yield their results as they complete (not in the order they were submitted).
+# Probes that do not finish within their timeout are reported as such, even if the thread cannot be interrupted
+# (name resolution and SQL connections do not support timeouts)
+def run_probes(probes, max_duration):
+    executor = get_probe_executor()
+    pending = {}
+    for index, probe in enumerate(probes):
+        timing = [None, None]
+        future = executor.submit(run_probe, probe, probe['timeout'], timing)
+        pending[future] = (index, probe, timing)
+    deadline = time.perf_counter() + max_duration
+    while pending:
+        now = time.perf_counter()
+        probe_deadlines = [timing[0] + probe['timeout'] for index, probe, timing in pending.values() if timing[0] != None]
+        wait_timeout = max(0, min(probe_deadlines + [deadline]) - now)
+        # Probes still in the queue start when another thread frees up, check again shortly to pick up their timeout
+        if len(probe_deadlines) < len(pending):
+            wait_timeout = min(wait_timeout, 0.5)
+        done, not_done = concurrent.futures.wait(pending, timeout=wait_timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        now = time.perf_counter()
+        for future in done:
+            index, probe, timing = pending.pop(future)
+            try:
+                yield get_probe_result(index, probe, 'ok', timing[1] - timing[0], result=future.result())
+            except Exception as e:
+                yield get_probe_result(index, probe, 'error', timing[1] - timing[0], error=str(e))
+        for future in not_done:
+            index, probe, timing = pending[future]
+            if timing[0] != None and now >= timing[0] + probe['timeout']:
+                del pending[future]
+                yield get_probe_result(index, probe, 'timeout', now - timing[0], error='Probe did not finish in {0} seconds'.format(probe['timeout']))
+            elif now >= deadline:
+                del pending[future]
+                future.cancel()
+                yield get_probe_result(index, probe, 'timeout', 0 if timing[0] == None else now - timing[0], error='Probe did not finish in {0} seconds (request limit)'.format(max_duration))
+
+# Flask route to run a batch of dns/rdns/http/tcp/sql probes in parallel, results are streamed back as NDJSON
+@app.route("/api/probe", methods=['POST'])
+def probe():
+    try:
+        body = request.get_json(force=True)
+        if isinstance(body, list):
+            body = {'probes': body}
+        default_timeout = float(body.get('timeout', get_variable_value('PROBE_TIMEOUT', 5)))
+        max_duration = float(body.get('maxduration', get_variable_value('PROBE_MAX_DURATION', 60)))
+        probes = []
+        for probe in body.get('probes', []):
+            if probe.get('type') not in probe_functions:
+                return jsonify('Probe type ' + str(probe.get('type')) + ' not supported, use ' + '/'.join(probe_functions))
+            if probe.get('target') == None:
+                return jsonify('Probe ' + str(len(probes)) + ' has no target')
+            probe = dict(probe)
+            probe['timeout'] = float(probe.get('timeout', default_timeout))
+            probes.append(probe)
+        app.logger.info('Running {0} probes'.format(len(probes)))
+        ndjson = (json.dumps(probe_result, default=str) + '\n' for probe_result in run_probes(probes, max_duration))
+        return Response(ndjson, mimetype='application/x-ndjson')
+    except Exception as e:
+        return jsonify(str(e))
+
 # Flask route to connect to MySQL
 @app.route("/api/mysql", methods=['GET'])
 def mysql():
@@ -778,7 +3323,7 @@ def mysql():
         try:
             # Get variables
             mysql_fqdn = request.args.get('SQL_SERVER_FQDN') or get_variable_value('SQL_SERVER_FQDN')
-            mysql_user = request.args.get('SQL_SERVER_USERNAME') or get_variable_value('SQL_SERVER)USERNAME')
+            mysql_user = request.args.get('SQL_SERVER_USERNAME') or get_variable_value('SQL_SERVER_USERNAME')
             mysql_pswd = request.args.get('SQL_SERVER_PASSWORD') or get_variable_value('SQL_SERVER_PASSWORD')
             mysql_db = request.args.get('SQL_SERVER_DB') or get_variable_value('SQL_SERVER_DB')
             app.logger.info('Values to connect to MySQL:')
@@ -795,16 +3340,23 @@ def mysql():
             # Different connection strings if using a database or not
             if mysql_db == None:
                 app.logger.info('Connecting to mysql server ' + str(mysql_fqdn) + ', username ' + str(mysql_user) + ', password ' + str(mysql_pswd))
-                db = pymysql.connect(mysql_fqdn, mysql_user, mysql_pswd)
+                connect = lambda: pymysql.connect(host=mysql_fqdn, user=mysql_user, passwd=mysql_pswd)
             else:
                 app.logger.info('Connecting to mysql server ' + str(mysql_fqdn) + ', database ' + str(mysql_db) + ', username ' + str(mysql_user) + ', password ' + str(mysql_pswd))
-                db = pymysql.connect(mysql_fqdn, mysql_user, mysql_pswd, mysql_db)
+                connect = lambda: pymysql.connect(host=mysql_fqdn, user=mysql_user, passwd=mysql_pswd, database=mysql_db)
+            # Share the pool with send_sql_query (the SSL setting is part of the pool key)
+            pool = get_sql_pool('mysql', mysql_fqdn, mysql_db, mysql_user, 'no', mysql_pswd)
+            db = pool.acquire(connect)
             # Send query and extract data
-            cursor = db.cursor()
-            cursor.execute("SELECT VERSION()")
-            data = cursor.fetchone()
-            app.logger.info('Closing SQL connection...') 
-            db.close()
+            try:
+                cursor = db.cursor()
+                cursor.execute("SELECT VERSION()")
+                data = cursor.fetchone()
+            except Exception:
+                pool.release(db, discard=True)
+                raise
+            app.logger.info('Returning SQL connection to the pool...')
+            pool.release(db)
             msg = {
                 'sql_output': str(data)
             }          
@@ -812,6 +3364,111 @@ def mysql():
         except Exception as e:
             return jsonify(str(e))
 
+# Flask route to show the status and metrics of the SQL connection pools
+@app.route("/api/sqlpool", methods=['GET'])
+def sqlpool():
+    if request.method == 'GET':
+        try:
+            with sql_pools_lock:
+                pools = list(sql_pools.values())
+            msg = {
+                'sql_pools': [pool.get_stats() for pool in pools]
+            }
+            return jsonify(msg)
+        except Exception as e:
+            return jsonify(str(e))
+
+# Flask route to show the depth and metrics of the srciplog write buffer, flush=yes writes the buffered rows
+@app.route("/api/sqlsrciplogbuffer", methods=['GET'])
+def sqlsrciplogbuffer():
+    if request.method == 'GET':
+        try:
+            msg = {}
+            if request.args.get('flush') == 'yes':
+                msg['rows_written'] = srciplog_buffer.flush()
+            msg.update(srciplog_buffer.get_stats())
+            return jsonify(msg)
+        except Exception as e:
+            return jsonify(str(e))
+
+# Flask route to show the contents (without values) and metrics of the Azure Key Vault secret cache
+@app.route("/api/akvcache", methods=['GET'])
+def akvcache():
+    if request.method == 'GET':
+        try:
+            return jsonify(akv_secret_cache.get_stats())
+        except Exception as e:
+            return jsonify(str(e))
+
+# Flask route to expose the metrics of this process in the Prometheus text format
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Flask route to show the startup time of the API: time to load this module, time of the warm-up step (WARMUP_IMPORTS)
+# and time of each lazily imported module. With benchmark=yes each lazy module and this module are imported in new
+# Python processes too, to measure their cold import times (this takes a few seconds)
+@app.route("/api/startup", methods=['GET'])
+def startup():
+    if request.method == 'GET':
+        try:
+            msg = {
+                'module_load_ms': round(module_load_seconds * 1000, 3),
+                'warmup_ms': round(warmup_seconds * 1000, 3) if warmup_seconds != None else None,
+                'lazy_imports': [module.get_stats() for module in lazy_modules]
+            }
+            if request.args.get('benchmark') == 'yes':
+                module_names = [os.path.splitext(os.path.basename(__file__))[0]] + [module.name for module in lazy_modules]
+                msg['cold_imports'] = benchmark_imports(module_names)
+            return jsonify(msg)
+        except Exception as e:
+            return jsonify(str(e))
+
+# Import time of each module in a new Python process (started in the directory of this file)
+def benchmark_imports(module_names):
+    results = []
+    for module_name in module_names:
+        code = 'import time; start = time.perf_counter(); import {0}; print(time.perf_counter() - start)'.format(module_name)
+        try:
+            output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, timeout=120)
+            if output.returncode == 0:
+                results.append({'module': module_name, 'import_ms': round(float(output.stdout.split()[-1]) * 1000, 3)})
+            else:
+                results.append({'module': module_name, 'error': output.stderr.strip().split('\n')[-1]})
+        except Exception as e:
+            results.append({'module': module_name, 'error': str(e)})
+    return results
+
+# Optional warm-up step, run once before serving requests (in the production server this is the master process, so
+# the worker processes inherit the imported modules). WARMUP_IMPORTS can be "no" (default), "yes" for the driver of
+# SQL_ENGINE (and the Azure SDK if the password is taken from Key Vault), "all" for every lazy module, or a
+# comma-separated list of module names
+warmup_seconds = None
+
+def warmup_imports():
+    global warmup_seconds
+    warmup = get_variable_value('WARMUP_IMPORTS', 'no')
+    if warmup == 'no':
+        return
+    if warmup == 'yes':
+        modules = list(engine_modules.get(get_variable_value('SQL_ENGINE') or 'sqlserver', []))
+        if get_variable_value('AKV_NAME'):
+            modules += [azure_identity, azure_keyvault_secrets]
+    elif warmup == 'all':
+        modules = lazy_modules
+    else:
+        module_names = [module_name.strip() for module_name in warmup.split(',')]
+        modules = [module for module in lazy_modules if module.name in module_names]
+    start = time.perf_counter()
+    for module in modules:
+        try:
+            module.load(imported_by='warmup')
+        except ImportError as e:
+            print('Could not import module ' + module.name + ': ' + str(e))
+    warmup_seconds = time.perf_counter() - start
+    print('Imported {0} in {1} seconds'.format(', '.join(module.name for module in modules), round(warmup_seconds, 3)))
+
 # Gets the web port out of an environment variable, or defaults to 8080
 def get_web_port():
     web_port=os.environ.get('PORT')
@@ -822,11 +3479,155 @@ def get_web_port():
         print("Port supplied as environment variable:", web_port)
     return web_port
 
-# Ignore warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
+# Number of CPUs available to the container: the cgroup CPU quota (v2 or v1) if there is one,
+# otherwise the CPUs this process can run on
+def get_cpu_limit():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except Exception:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as fh:
+            quota, period = fh.read().split()[:2]
+        if quota != 'max':
+            return max(1, min(cpus, math.ceil(int(quota) / int(period))))
+        return cpus
+    except Exception:
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as fh:
+            quota = int(fh.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as fh:
+            period = int(fh.read())
+        if quota > 0:
+            return max(1, min(cpus, math.ceil(quota / period)))
+    except Exception:
+        pass
+    return cpus
+
+# Start the background threads of the process. Threads do not survive a fork, so this
+# runs again in each worker process of the production server
+def start_background_tasks():
+    config.start_watcher()
+    network_info.start_refresher()
+    srciplog_buffer.start_flusher()
+    start_metrics_saver()
+
+# Write what is still buffered when the process exits (gunicorn workers call this in their worker_exit hook too).
+# The number of records written is logged, so that the logs of a stopped container show that the flush ran
+def stop_background_tasks():
+    try:
+        pending = srciplog_buffer.depth
+        if pending > 0:
+            written = srciplog_buffer.flush()
+            print('Flushed {0} of {1} buffered srciplog records before exiting (process {2})'.format(written, pending, os.getpid()))
+    except Exception as e:
+        print('Error flushing the srciplog buffer: ' + str(e))
+    if metrics_saver_pid == os.getpid():
+        try:
+            save_metrics()
+        except Exception as e:
+            print('Error saving metrics: ' + str(e))
+
+atexit.register(stop_background_tasks)
 
-# Set web port
-web_port=get_web_port()
+# A lock held by a thread of the parent process when it forks stays locked forever in the child, where that thread
+# does not exist. The child gets new locks, and drops what belongs to the threads and connections of the parent
+# (thread pools, SQL connections, HTTP session, buffered rows and background jobs)
+def reinit_after_fork():
+    global ioperf_jobs, ioperf_jobs_lock, ioperf_executor, sql_pools, sql_pools_lock, http_session, http_session_lock, probe_executor, probe_executor_lock
+    ioperf_jobs = collections.OrderedDict()
+    ioperf_jobs_lock = threading.Lock()
+    ioperf_executor = None
+    sql_pools = {}
+    sql_pools_lock = threading.Lock()
+    http_session = None
+    http_session_lock = threading.Lock()
+    probe_executor = None
+    probe_executor_lock = threading.Lock()
+    config.lock = threading.Lock()
+    akv_secret_cache.lock = threading.Lock()
+    akv_secret_cache.fetch_locks = {}
+    akv_secret_cache.refreshing = set()
+    dns_cache.lock = threading.Lock()
+    network_info.lock = threading.Lock()
+    srciplog_buffer.condition = threading.Condition()
+    srciplog_buffer.flush_lock = threading.Lock()
+    srciplog_buffer.start_lock = threading.Lock()
+    srciplog_buffer.rows = collections.OrderedDict()
+    srciplog_buffer.depth = 0
+    for metric in metrics_registry:
+        metric.lock = threading.Lock()
 
-app.run(host='0.0.0.0', port=web_port, debug=True, use_reloader=False)
+os.register_at_fork(after_in_child=reinit_after_fork)
+
+# App factory for WSGI servers, for example: gunicorn 'sql_api:create_app()'. The background threads are started
+# in the process calling it, so with gunicorn it should not be used with --preload (it would run in the master)
+def create_app():
+    if warmup_seconds == None:
+        warmup_imports()
+    start_background_tasks()
+    return app
+
+# Production server: gunicorn with several pre-forked worker processes, each of them with several threads.
+# Per default there are 2 workers per CPU (according to the cgroup CPU quota) plus one
+def run_production_server(web_port):
+    from gunicorn.app.base import BaseApplication
+
+    class SqlApiServer(BaseApplication):
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    cpus = get_cpu_limit()
+    options = {
+        'bind': '0.0.0.0:' + str(web_port),
+        'workers': int(get_variable_value('WEB_WORKERS') or 2 * cpus + 1),
+        'threads': int(get_variable_value('WEB_THREADS') or 4),
+        'worker_class': 'gthread',
+        'keepalive': int(get_variable_value('WEB_KEEPALIVE') or 5),
+        'timeout': int(get_variable_value('WEB_TIMEOUT') or 300),
+        'graceful_timeout': int(get_variable_value('WEB_GRACEFUL_TIMEOUT') or 30),
+        'post_fork': lambda server, worker: start_background_tasks(),
+        'worker_exit': lambda server, worker: stop_background_tasks()
+    }
+    print("Starting production web server with {0} workers and {1} threads per worker ({2} CPUs available)...".format(options['workers'], options['threads'], cpus))
+    # The master process only imports modules: it starts no threads, they are started in each worker by post_fork
+    warmup_imports()
+    prune_metrics_dir()
+    SqlApiServer(app, options).run()
+
+# Time to load this module, reported by /api/startup
+module_load_seconds = time.perf_counter() - module_load_start
+
+if __name__ == '__main__':
+    # Ignore warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+
+    # Set web port
+    web_port=get_web_port()
+
+    # Exit cleanly on SIGTERM (docker stop), so that the atexit handlers flush the buffers. gunicorn installs its own
+    # handlers, this one is for the Flask web server
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # SERVER_MODE=development runs the Flask development server with the debugger
+    server_mode = get_variable_value('SERVER_MODE', 'production')
+    if server_mode == 'development':
+        create_app().run(host='0.0.0.0', port=web_port, debug=True, use_reloader=False)
+    else:
+        try:
+            run_production_server(web_port)
+        except ImportError:
+            print("gunicorn is not available, falling back to the Flask web server")
+            create_app().run(host='0.0.0.0', port=web_port, threaded=True, use_reloader=False)
@@ -0,0 +1,86 @@
+// Push mode of the dashboard (DASH_UPDATE_MODE=push): the chart is rendered once by Dash, and then updated in place
+// with the events of the /stream/srciplog Server-Sent Events endpoint. A "snapshot" event carries all the IPs and
+// counts (when connecting, or when IPs have been removed from the table), a "delta" event only the count increments
+// of existing IPs and the new IPs
+(function () {
+    var state = {x: [], y: []};
+    var drawn = null;          // plotly div where the current state has been drawn
+
+    function getGraph() {
+        return document.querySelector('#accessgraph-figure .js-plotly-plot');
+    }
+
+    // Draws the whole state, if the chart has been rendered (or rendered again) by Dash since the last draw
+    function draw() {
+        var gd = getGraph();
+        if (!gd || !window.Plotly) {
+            return false;
+        }
+        if (gd !== drawn) {
+            window.Plotly.restyle(gd, {x: [state.x.slice()], y: [state.y.slice()]}, [0]);
+            drawn = gd;
+        }
+        return true;
+    }
+
+    function onSnapshot(e) {
+        var data = JSON.parse(e.data);
+        state = {x: data.x, y: data.y};
+        drawn = null;
+        draw();
+    }
+
+    function onDelta(e) {
+        var data = JSON.parse(e.data);
+        var changed = false;
+        Object.keys(data.increments).forEach(function (ip) {
+            var i = state.x.indexOf(ip);
+            if (i >= 0) {
+                state.y[i] += data.increments[ip];
+                changed = true;
+            }
+        });
+        state.x = state.x.concat(data.x);
+        state.y = state.y.concat(data.y);
+        var gd = getGraph();
+        if (!gd || gd !== drawn || !window.Plotly) {
+            // Not drawn yet, the whole state will be drawn by the next draw()
+            draw();
+            return;
+        }
+        if (changed) {
+            window.Plotly.restyle(gd, {y: [state.y.slice(0, state.y.length - data.y.length)]}, [0]);
+        }
+        if (data.x.length > 0) {
+            window.Plotly.extendTraces(gd, {x: [data.x], y: [data.y]}, [0]);
+        }
+    }
+
+    function connect() {
+        var container = document.getElementById('accessgraph');
+        if (!container) {
+            // The Dash layout has not been rendered yet
+            setTimeout(connect, 200);
+            return;
+        }
+        var url = container.getAttribute('data-stream');
+        if (!url || !window.EventSource) {
+            return;
+        }
+        var source = new EventSource(url);
+        source.addEventListener('snapshot', onSnapshot);
+        source.addEventListener('delta', onDelta);
+        // The chart might be rendered by Dash after the first event has been received
+        var timer = setInterval(function () {
+            if (draw() && drawn) {
+                clearInterval(timer);
+            }
+        }, 200);
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', connect);
+    } else {
+        connect();
+    }
+})();
@@ -3,10 +3,11 @@ import socket, struct
 import sys
 import time
 import warnings
+import threading
 import requests
 import dns.resolver
-import psycopg2
 import datetime
+import json
 
 import plotly
 import plotly.graph_objs as go
@@ -15,10 +16,22 @@ import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 from dash.dependencies import Input, Output
+from flask import Response
 
-# Database modules
-import pyodbc
-import pymysql
+# Database modules: only the one for the engine in SQL_ENGINE is required
+try:
+    import pyodbc
+except:
+    pass
+try:
+    import pymysql
+    import pymysql.cursors
+except:
+    pass
+try:
+    import psycopg2
+except:
+    pass
 
 
 # Style
@@ -27,9 +40,10 @@ import pymysql
 # external_stylesheets = [dbc.themes.COSMO]
 external_stylesheets = [dbc.themes.CERULEAN]
 
-# Layout
+# Layout (a function, set as the app layout once the configuration has been read, see below)
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
-app.layout = dbc.Container([
+def serve_layout():
+    return dbc.Container([
         dbc.Row(
             html.Table([
                 html.Tr([
@@ -48,14 +62,17 @@ app.layout = dbc.Container([
                     html.P("The real-time chart on the right shows the source IP addresses that have sent traffic to the production database. All traffic is coming from private addresses, and the configuration for the application gateway backends does not need to be modified thanks the the DNS-based service discovery mechanism."),
                 ], style={'width': '70%'}),
                 html.Td([
-                    html.Div(id='accessgraph'),
+                    # In push mode the script in assets/srciplog_push.js updates the chart with the deltas sent to data-stream
+                    html.Div(id='accessgraph', **({'data-stream': '/stream/srciplog'} if get_variable_value('DASH_UPDATE_MODE', 'interval') == 'push' else {})),
                 ], style={'width': '30%'})
             ])
         ], style={'width': '100%'}),
         dcc.Interval(
             id='interval-component',
-            interval=1*2000, # in milliseconds
-            n_intervals=0
+            interval=int(float(get_variable_value('DASH_REFRESH_INTERVAL', 2)) * 1000), # in milliseconds
+            n_intervals=0,
+            # In push mode the interval only fires once, to render the chart when the page is loaded
+            disabled=get_variable_value('DASH_UPDATE_MODE', 'interval') == 'push'
         )
     ])
 
@@ -63,64 +80,12 @@ app.layout = dbc.Container([
 @app.callback(Output(component_id='accessgraph', component_property='children'),
               Input('interval-component', 'n_intervals'))
 def render_graph(n):
-    try:
-        # Get info and build the connection to the SQL server
-        if sql_engine == "sqlserver":
-            drivers = pyodbc.drivers()
-            # print('Available ODBC drivers:', drivers)   # DEBUG
-            if len(drivers) == 0:
-                # app.logger.error('Oh oh, it looks like you have no ODBC drivers installed :(')
-                print('Oh oh, it looks like you have no ODBC drivers installed :(')
-            else:
-                # Take first driver, for our basic stuff any should do
-                driver = drivers[0]
-                if sql_server_db == None:
-                    # app.logger.info("Building connection string with no Database")
-                    print("Building connection string with no Database")
-                    cx_string = "Driver={{{0}}};Server=tcp:{1},1433;Uid={2};Pwd={3};Encrypt=yes;TrustServerCertificate=yes;Connection Timeut=30;".format(driver, sql_server_fqdn, sql_server_username, sql_server_password)
-                else:
-                    # app.logger.info("Building connection string with Database")
-                    print("Building connection string with Database")
-                    cx_string = "Driver={{{0}}};Server=tcp:{1},1433;Database={2};Uid={3};Pwd={4};Encrypt=yes;TrustServerCertificate=yes;Connection Timeut=30;".format(driver, sql_server_fqdn, sql_server_db, sql_server_username, sql_server_password)
-                # app.logger.info('connection string: ' + cx_string)
-                print('connection string: ' + cx_string)
-            # Connect to DB
-            # app.logger.info('Connecting to database server ' + sql_server_fqdn + ' - ' + get_ip(sql_server_fqdn) + '...')
-            print('Connecting to database server ' + sql_server_fqdn + ' - ' + get_ip(sql_server_fqdn) + '...')
-            try:
-                cx = init_odbc(cx_string)
-                cx.add_output_converter(-150, handle_sql_variant_as_string)
-                cursor = cx.cursor()
-            except Exception as e:
-                if is_valid_ipv4_address(sql_server_fqdn):
-                    error_msg = 'SQL Server FQDN should not be an IP address when targeting Azure SQL Database, maybe this is a problem?'
-                else:
-                    error_msg = 'Connection to server ' + sql_server_fqdn + ' failed, you might have to update the firewall rules or check your credentials?'
-                # app.logger.info(error_msg)
-                # app.logger.error(e)
-                print(error_msg)
-                print(e)
-                return None
-        else:
-            app.logger.error('Sorry, this dashboard only supports the SQL Server, MySQL and Postgres are on the roadmap')
-
-        # Send Query
-        app.logger.info("Sending SQL query to cursor...")
-        print("Sending SQL query...")
-        sql_query = "SELECT ip, COUNT(ip) FROM srciplog GROUP BY ip;"
-        cursor.execute(sql_query)
-        sql_result = cursor.fetchall()
-        app.logger.info("Data retrieved: {0}".format(str(sql_result)))
-        # Separate data in two lists, one for each axis
-        x_axis=[sql_result[i][0] for i in range(0, len(sql_result))]
-        y_axis=[sql_result[i][1] for i in range(0, len(sql_result))]
-    except Exception as e:
-        app.logger.info("Error: {0}".format(str(e)))
-        x_axis = []
-        y_axis = []
+    # The data comes from the snapshot of the shared poller, the database is not queried here
+    x_axis, y_axis, version = srciplog_poller.get_snapshot()
     # Return graph object
     app.logger.info("Graphing x: {0} and y: {1}".format(str(x_axis), str(y_axis)))
     return [dcc.Graph(
+        id='accessgraph-figure',
         figure={
             'data': [
                 {'x': x_axis, 'y': y_axis, 'type': 'bar', 'name': 'Source IP'}
@@ -129,17 +94,358 @@ def render_graph(n):
          }
     )]
 
+# Push mode: the browser keeps a Server-Sent Events connection open and gets the full data once, then only the
+# count increments of existing IPs and the new IPs, when the data changes. While the data does not change, a comment
+# line is sent every DASH_KEEPALIVE_INTERVAL seconds, so that proxies do not close the idle connection and closed
+# connections are noticed (writing to them fails) instead of holding a server thread forever
+@app.server.route('/stream/srciplog')
+def stream_srciplog():
+    return Response(generate_srciplog_events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def generate_srciplog_events():
+    keepalive_interval = float(get_variable_value('DASH_KEEPALIVE_INTERVAL', 15))
+    snapshot = srciplog_poller.get_snapshot()
+    yield format_sse_event('snapshot', {'x': snapshot[0], 'y': snapshot[1]}, snapshot[2])
+    while True:
+        new_snapshot = srciplog_poller.wait_for_change(snapshot[2], timeout=keepalive_interval)
+        if new_snapshot[2] == snapshot[2]:
+            yield ': keepalive\n\n'
+            continue
+        delta = get_srciplog_delta(snapshot, new_snapshot)
+        if delta == None:
+            yield format_sse_event('snapshot', {'x': new_snapshot[0], 'y': new_snapshot[1]}, new_snapshot[2])
+        else:
+            yield format_sse_event('delta', delta, new_snapshot[2])
+        snapshot = new_snapshot
+
+# Differences between two snapshots of the poller, or None if the IPs changed in a way that cannot be expressed as
+# increments and new IPs (IPs removed or counts decreasing after a full count of the table)
+def get_srciplog_delta(old_snapshot, new_snapshot):
+    old_x, old_y = old_snapshot[0], old_snapshot[1]
+    new_x, new_y = new_snapshot[0], new_snapshot[1]
+    if new_x[:len(old_x)] != old_x:
+        return None
+    increments = {}
+    for ip, old_count, new_count in zip(old_x, old_y, new_y):
+        if new_count < old_count:
+            return None
+        if new_count > old_count:
+            increments[ip] = new_count - old_count
+    return {'increments': increments, 'x': new_x[len(old_x):], 'y': new_y[len(old_y):]}
+
+def format_sse_event(event, data, event_id):
+    return 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(event_id, event, json.dumps(data))
+
+# Database backends for the poller. Each backend opens the persistent connection to its engine, returns cursors that
+# stream the results from the server instead of buffering them in the client, and knows the parameter placeholder
+# and the schema filter of its driver
+class SqlServerBackend:
+
+    placeholder = '?'
+    columns_query = "SELECT column_name FROM information_schema.columns WHERE table_schema = SCHEMA_NAME() AND table_name = 'srciplog';"
+
+    def __init__(self, sql_server_fqdn, sql_server_db, sql_server_username, sql_server_password, use_ssl='yes'):
+        self.sql_server_fqdn = sql_server_fqdn
+        self.sql_server_db = sql_server_db
+        self.sql_server_username = sql_server_username
+        self.sql_server_password = sql_server_password
+        self.use_ssl = use_ssl
+
+    def connect(self):
+        drivers = pyodbc.drivers()
+        # print('Available ODBC drivers:', drivers)   # DEBUG
+        if len(drivers) == 0:
+            raise Exception('Oh oh, it looks like you have no ODBC drivers installed :(')
+        # Take first driver, for our basic stuff any should do
+        driver = drivers[0]
+        if self.sql_server_db == None:
+            print("Building connection string with no Database")
+            cx_string = "Driver={{{0}}};Server=tcp:{1},1433;Uid={2};Pwd={3};Encrypt=yes;TrustServerCertificate=yes;Connection Timeut=30;".format(driver, self.sql_server_fqdn, self.sql_server_username, self.sql_server_password)
+        else:
+            print("Building connection string with Database")
+            cx_string = "Driver={{{0}}};Server=tcp:{1},1433;Database={2};Uid={3};Pwd={4};Encrypt=yes;TrustServerCertificate=yes;Connection Timeut=30;".format(driver, self.sql_server_fqdn, self.sql_server_db, self.sql_server_username, self.sql_server_password)
+        print('Connecting to database server ' + str(self.sql_server_fqdn) + ' - ' + str(get_ip(self.sql_server_fqdn)) + '...')
+        try:
+            cx = init_odbc(cx_string)
+            cx.add_output_converter(-150, handle_sql_variant_as_string)
+            return cx
+        except Exception as e:
+            if is_valid_ipv4_address(self.sql_server_fqdn):
+                error_msg = 'SQL Server FQDN should not be an IP address when targeting Azure SQL Database, maybe this is a problem?'
+            else:
+                error_msg = 'Connection to server ' + str(self.sql_server_fqdn) + ' failed, you might have to update the firewall rules or check your credentials?'
+            raise Exception(error_msg + ' (' + str(e) + ')')
+
+    # ODBC cursors are forward-only and read-only per default, the rows are sent by the server as they are fetched
+    def get_cursor(self, cx):
+        return cx.cursor()
+
+    # Called after each query, the connection is in autocommit mode so there is nothing to do
+    def end_query(self, cx):
+        pass
+
+# Azure Database for MySQL, with the same connection conventions as the API
+class MySqlBackend(SqlServerBackend):
+
+    placeholder = '%s'
+    columns_query = "SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = 'srciplog';"
+
+    def connect(self):
+        # The user must be in the format user@server
+        sql_server_name = self.sql_server_fqdn.split('.')[0]
+        if not sql_server_name:
+            raise Exception('MySql server name could not be retrieved out of FQDN')
+        sql_server_username = self.sql_server_username + '@' + sql_server_name
+        print('Connecting to mysql server ' + str(self.sql_server_fqdn) + ' - ' + str(get_ip(self.sql_server_fqdn)) + ', username ' + sql_server_username + '...')
+        # Autocommit, otherwise the persistent connection would keep reading the snapshot of its first transaction.
+        # With SSL the traffic is encrypted without validating the server certificate (like TrustServerCertificate for SQL Server)
+        if self.use_ssl == 'yes':
+            ssl = {'verify_mode': 'none'}
+        else:
+            ssl = None
+        return pymysql.connect(host=self.sql_server_fqdn, user=sql_server_username, passwd=self.sql_server_password, database=self.sql_server_db,
+                               ssl=ssl, connect_timeout=30, autocommit=True)
+
+    # Unbuffered cursor: the rows are read from the socket while iterating instead of loaded in memory by execute
+    def get_cursor(self, cx):
+        return cx.cursor(pymysql.cursors.SSCursor)
+
+# Azure Database for PostgreSQL, with the same connection conventions as the API
+class PostgresBackend(SqlServerBackend):
+
+    placeholder = '%s'
+    columns_query = "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'srciplog';"
+
+    def connect(self):
+        # The user must be in the format user@server
+        sql_server_name = self.sql_server_fqdn.split('.')[0]
+        if not sql_server_name:
+            raise Exception('Postgres server name could not be retrieved out of FQDN')
+        sql_server_username = self.sql_server_username + '@' + sql_server_name
+        print('Connecting to postgres server ' + str(self.sql_server_fqdn) + ' - ' + str(get_ip(self.sql_server_fqdn)) + ', username ' + sql_server_username + '...')
+        return psycopg2.connect(host=self.sql_server_fqdn, user=sql_server_username, password=self.sql_server_password,
+                                dbname=self.sql_server_db if self.sql_server_db != None else 'postgres',
+                                sslmode='require' if self.use_ssl == 'yes' else 'prefer', connect_timeout=30)
+
+    # Named cursors are server-side cursors (DECLARE ... CURSOR), the rows are fetched in batches while iterating
+    def get_cursor(self, cx):
+        return cx.cursor(name='srciplog_poller')
+
+    # Server-side cursors only live inside a transaction, which is closed after each query so that the next poll
+    # sees the rows committed in the meantime and the connection is not left idle in transaction
+    def end_query(self, cx):
+        cx.rollback()
+
+sql_backends = {
+    'sqlserver': SqlServerBackend,
+    'mysql': MySqlBackend,
+    'postgres': PostgresBackend
+}
+
+# Shared poller of the srciplog table. A single background thread per process keeps a connection to the database
+# and the number of connections per source IP in memory: every refresh_interval seconds it only reads the rows
+# added since the last poll (using the id column as high-water mark), and every resync_interval seconds it counts
+# the whole table again (to pick up deleted rows, or rows committed out of id order). The callbacks of all
+# browser sessions are served from the last snapshot. Tables created by older versions of the API (without the
+# id column) are counted in full on every poll
+class SrcIpLogPoller:
+
+    def __init__(self, refresh_interval=2, resync_interval=300):
+        self.refresh_interval = refresh_interval
+        self.resync_interval = resync_interval
+        self.counts = {}        # ip -> number of connections, in the order the IPs were seen for the first time
+        self.last_id = None
+        self.last_resync = 0
+        self.incremental = True
+        self.version = 0
+        self.snapshot = ([], [], 0)
+        self.backend = None
+        self.cx = None
+        self.cx_settings = None
+        self.poller_pid = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    # Persistent connection, opened again if the connection settings change (for example a rotated password)
+    def get_connection(self):
+        # Variables are read from the config resolver (no file I/O) so that rotated secrets are picked up
+        cx_settings = (get_variable_value('SQL_ENGINE', 'sqlserver'), get_variable_value('SQL_SERVER_FQDN'), get_variable_value('SQL_SERVER_DB'),
+                       get_variable_value('SQL_SERVER_USERNAME'), get_variable_value('SQL_SERVER_PASSWORD'), get_variable_value('USE_SSL', 'yes'))
+        if not cx_settings[0] in sql_backends:
+            raise Exception('SQL engine ' + str(cx_settings[0]) + ' not supported, it should be one of ' + ', '.join(sql_backends.keys()))
+        if self.cx != None and cx_settings != self.cx_settings:
+            self.close()
+        if self.cx == None:
+            self.backend = sql_backends[cx_settings[0]](*cx_settings[1:])
+            self.cx = self.backend.connect()
+            # The high-water mark is not valid in another database, the next poll counts the whole table
+            if cx_settings != self.cx_settings:
+                self.last_id = None
+            self.cx_settings = cx_settings
+        return self.cx
+
+    def close(self):
+        try:
+            self.cx.close()
+        except Exception:
+            pass
+        self.cx = None
+
+    # Runs a query in a server-side cursor of the backend, and returns the rows as they are streamed
+    def query(self, sql_query, params=None):
+        cx = self.get_connection()
+        cursor = self.backend.get_cursor(cx)
+        try:
+            if params == None:
+                cursor.execute(sql_query)
+            else:
+                cursor.execute(sql_query, params)
+            return [tuple(row) for row in cursor]
+        finally:
+            cursor.close()
+            self.backend.end_query(cx)
+
+    # Tables created by older versions of the API have no id column
+    def has_id_column(self):
+        return 'id' in [row[0].lower() for row in self.query(self.backend.columns_query)]
+
+    def poll(self):
+        self.get_connection()
+        full = self.last_id == None or not self.incremental or time.time() - self.last_resync > self.resync_interval
+        if full:
+            incremental = self.has_id_column()
+            if incremental != self.incremental:
+                print('The srciplog table has {0} id column'.format('an' if incremental else 'no'))
+                self.incremental = incremental
+        if not self.incremental:
+            rows = [(row[0], row[1], None) for row in self.query("SELECT ip, COUNT(ip) FROM srciplog GROUP BY ip;")]
+        elif full:
+            rows = self.query("SELECT ip, COUNT(ip), MAX(id) FROM srciplog GROUP BY ip;")
+        else:
+            rows = self.query("SELECT ip, COUNT(ip), MAX(id) FROM srciplog WHERE id > {0} GROUP BY ip;".format(self.backend.placeholder), (self.last_id,))
+        if full:
+            counts = {ip: 0 for ip in self.counts}
+            self.last_resync = time.time()
+            self.last_id = None
+        else:
+            counts = dict(self.counts)
+        for ip, count, max_id in rows:
+            counts[ip] = (0 if full else counts.get(ip, 0)) + count
+            if max_id != None and (self.last_id == None or max_id > self.last_id):
+                self.last_id = max_id
+        # IPs no longer in the table after a full count are removed
+        if full:
+            counts = {ip: count for ip, count in counts.items() if count > 0}
+        if counts != self.counts:
+            self.counts = counts
+            with self.lock:
+                self.version += 1
+                self.snapshot = (list(counts.keys()), list(counts.values()), self.version)
+                self.changed.notify_all()
+            app.logger.info("Data retrieved: {0}".format(str(counts)))
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print('Error polling the srciplog table: ' + str(e))
+                self.close()
+            time.sleep(self.refresh_interval)
+
+    # Start the poller thread (again if the process has been forked)
+    def start_poller(self):
+        if self.poller_pid != os.getpid():
+            self.poller_pid = os.getpid()
+            self.cx = None
+            threading.Thread(target=self.run, daemon=True).start()
+
+    # Returns the IPs, their number of connections and a version number that changes when the data changes
+    def get_snapshot(self):
+        with self.lock:
+            return self.snapshot
+
+    # Blocks until the version of the snapshot is different from the one passed, and returns the new snapshot
+    def wait_for_change(self, version, timeout=None):
+        with self.changed:
+            self.changed.wait_for(lambda: self.snapshot[2] != version, timeout)
+            return self.snapshot
+
+# Configuration values coming from environment variables or from files in the secrets directory (where
+# Kubernetes mounts secrets). The files are read once at startup, and a background thread re-reads them
+# when the modification time of the directory or of any file changes, so that rotated secrets are picked
+# up without doing any file I/O when serving requests
+# The same class is in api/sql_api.py: each app is deployed as a single file, keep both copies identical
+class ConfigResolver:
+
+    def __init__(self, secrets_path='/secrets', poll_interval=10):
+        self.secrets_path = secrets_path
+        self.poll_interval = poll_interval
+        self.secrets = {}
+        self.signature = None
+        self.watcher_pid = None
+        self.lock = threading.Lock()
+        self.reload()
+
+    # Modification times and sizes of the secrets directory and its files (following symlinks)
+    def get_signature(self):
+        try:
+            entries = [(self.secrets_path, os.stat(self.secrets_path).st_mtime_ns)]
+            for entry in os.scandir(self.secrets_path):
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            return tuple(sorted(entries))
+        except Exception:
+            return None
+
+    def reload(self):
+        signature = self.get_signature()
+        secrets = {}
+        if signature != None:
+            for entry in os.scandir(self.secrets_path):
+                try:
+                    if entry.is_file():
+                        with open(entry.path, 'r') as file:
+                            secrets[entry.name] = file.read().replace('\n', '')
+                except Exception:
+                    pass
+        with self.lock:
+            self.secrets = secrets
+            self.signature = signature
+
+    def watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                if self.get_signature() != self.signature:
+                    print('Change detected in ' + self.secrets_path + ', reloading secrets...')
+                    self.reload()
+            except Exception as e:
+                print('Error reloading secrets from ' + self.secrets_path + ': ' + str(e))
+
+    # Start the watcher thread (again if the process has been forked, with a new lock in case
+    # the watcher of the parent process was holding it when forking)
+    def start_watcher(self):
+        if self.watcher_pid != os.getpid():
+            if self.watcher_pid != None:
+                self.lock = threading.Lock()
+            self.watcher_pid = os.getpid()
+            threading.Thread(target=self.watch, daemon=True).start()
+
+    def get(self, variable_name, default_value=None):
+        variable_value = os.environ.get(variable_name)
+        if variable_value == None:
+            with self.lock:
+                variable_value = self.secrets.get(variable_name)
+        if variable_value == None:
+            variable_value = default_value
+        return variable_value
+
 # Get variable values from environment variables or from the file system
 def get_variable_value(variable_name, default_value = None):
-    variable_value = os.environ.get(variable_name)
-    basis_path='/secrets'
-    variable_path = os.path.join(basis_path, variable_name)
-    if variable_value == None and os.path.isfile(variable_path):
-        with open(variable_path, 'r') as file:
-            variable_value = file.read().replace('\n', '')
-    if (variable_value == None) and (default_value != None):
-        variable_value = default_value
-    return variable_value
+    return config.get(variable_name, default_value)
 
 # Gets the web port out of an environment variable, or defaults to 8080
 def get_web_port():
@@ -172,9 +478,10 @@ def is_valid_ipv4_address(address):
         return False
     return True
 
-# Initialize ODBC connection to database
+# Initialize ODBC connection to database (in autocommit mode, so that the connection does not keep a transaction
+# open between polls)
 def init_odbc(cx_string):
-    cnxn = pyodbc.connect(cx_string)
+    cnxn = pyodbc.connect(cx_string, autocommit=True)
     return cnxn
 
 # To add to SQL cx to handle output
@@ -184,12 +491,13 @@ def handle_sql_variant_as_string(value):
 
 # Global variables
 print ("Initializing variables...")
-sql_server_fqdn = get_variable_value('SQL_SERVER_FQDN')
-sql_server_db = get_variable_value('SQL_SERVER_DB')
-sql_server_username = get_variable_value('SQL_SERVER_USERNAME')
-sql_server_password = get_variable_value('SQL_SERVER_PASSWORD')
-sql_engine = get_variable_value('SQL_ENGINE', default_value='sqlserver')
-use_ssl = get_variable_value('USE_SSL')
+config = ConfigResolver(secrets_path=os.environ.get('SECRETS_PATH', '/secrets'),
+                        poll_interval=int(os.environ.get('SECRETS_POLL_INTERVAL', '10')))
+config.start_watcher()
+srciplog_poller = SrcIpLogPoller(refresh_interval=float(get_variable_value('DASH_REFRESH_INTERVAL', 2)),
+                                 resync_interval=float(get_variable_value('DASH_RESYNC_INTERVAL', 300)))
+srciplog_poller.start_poller()
+app.layout = serve_layout
 
 if __name__ == '__main__':
     # Initialize